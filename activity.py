@@ -11,14 +11,19 @@
 # Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
 
 import os
-import shutil
+import sys
+import time
+import base64
+import hashlib
+import Queue
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from ConfigParser import ConfigParser
 import json
 from gettext import gettext as _
 
 from gi.repository import Gtk
 from gi.repository import Gdk
-from gi.repository import GdkPixbuf
 from gi.repository import GObject
 from gi.repository import GConf
 
@@ -47,11 +52,19 @@ from sugar3.graphics.objectchooser import ObjectChooser
 
 try:
     from sugar3.presence.wrapper import CollabWrapper
+    from sugar3.presence.wrapper import FT_STATE_COMPLETED, \
+        FT_STATE_CANCELLED
 except ImportError:
     from textchannelwrapper import CollabWrapper
+    from textchannelwrapper import FT_STATE_COMPLETED, FT_STATE_CANCELLED
 
 
 from reflectwindow import ReflectWindow
+from journalqueue import JournalQueue
+import reflectstore
+import reflectdb
+from searchindex import TagIndex, TextIndex, FieldIndex, QueryError, \
+    prefix_terms, match_any_prefix, is_query, parse_query, evaluate
 from graphics import Graphics, FONT_SIZES
 import utils
 
@@ -73,6 +86,57 @@ PICTURE_CMD = 'p'
 JOIN_CMD = 'r'
 SHARE_CMD = 'R'
 ACTIVITY_CMD = 'a'
+PICTURE_ARCHIVE_CMD = 'A'
+SYNC_CMD = 's'
+
+# Changes that are logged, and replayed to buddies who rejoin
+SYNCED_COMMANDS = [NEW_REFLECTION_CMD, TITLE_CMD, STAR_CMD, TAG_CMD,
+                   COMMENT_CMD, REFLECTION_CMD, IMAGE_REFLECTION_CMD,
+                   ACTIVITY_CMD]
+SYNC_LOG_SIZE = 1000  # ops kept by the sharer for rejoining buddies
+
+BATCH_CMD = 'b'
+# Changes that wait in the outbox to be sent several to a message; for
+# the coalesced ones only the newest per obj_id is sent.
+BATCHED_COMMANDS = SYNCED_COMMANDS
+COALESCED_COMMANDS = [TITLE_CMD, STAR_CMD, TAG_CMD]
+SEND_FLUSH_INTERVAL = 200  # ms a change may wait in the outbox
+SEND_BATCH_SIZE = 20  # changes that fill the outbox
+ARCHIVE_POLL_INTERVAL = 100  # ms between checks for a finished archive
+ARCHIVE_POLL_LIMIT = 50  # checks before reading the archive as it is
+
+LOG_COMPACT_SIZE = 512 * 1024  # bytes of change log before a new snapshot
+# Default durability of saves; a deployment can pick the cheaper
+# reflectstore.FSYNC_TIMER with the GConf key in utils.get_fsync_mode.
+FSYNC_MODE = reflectstore.FSYNC_ALWAYS
+# Received commands that change the words of a reflection
+TEXT_COMMANDS = [TITLE_CMD, COMMENT_CMD, REFLECTION_CMD]
+
+SEARCH_DELAY = 300  # ms without typing before the live search runs
+SEARCH_CHUNK_SIZE = 500  # reflections, tags or words checked per idle call
+
+# Sort through an in-memory SQLite copy of the sort keys, if sqlite3 is
+# available. Off by default: the sort has to return every reflection,
+# and sorted() over reflection_data is about twice as fast as the query
+# at 1000 to 50000 reflections, before the copy is even filled.
+USE_REFLECTION_DB = False
+
+# Journal metadata a reflection is built from
+JOURNAL_PROPERTIES = ['uid', 'title', 'timestamp', 'creation_time',
+                      'activity', 'description', 'tags', 'comments',
+                      'mime_type', 'preview']
+# Journal metadata compared by _sweep_journal to spot changed entries.
+# The Journal saves star and detail edits without moving the timestamp,
+# so the fields Reflect takes from it are fetched too; the preview, the
+# expensive one, is only fetched for new entries.
+JOURNAL_INDEX_PROPERTIES = ['uid', 'timestamp', 'title', 'tags', 'comments']
+JOURNAL_SWEEP_CHUNK = 10  # new entries fetched per idle call by the sweep
+
+IMPORT_WORKERS = 2  # threads decoding Journal entries
+IMPORT_FLUSH_INTERVAL = 100  # ms between hand-offs to the main loop
+IMPORT_FRAME_BUDGET = 0.05  # seconds of main-loop work per hand-off
+
+GObject.threads_init()
 
 
 class ReflectActivity(activity.Activity):
@@ -87,6 +151,79 @@ class ReflectActivity(activity.Activity):
 
         logging.error('setting reflection data to []')
         self.reflection_data = []
+        self._obj_id_index = {}
+        self.tag_index = TagIndex()
+        self.text_index = TextIndex()
+        # Stars, times, activities and authors for queries; brought up
+        # to date when a query is run, see _update_field_index
+        self.field_index = FieldIndex()
+        self._fields_stale = True
+        self._field_dirty = set()
+        self.journal_queue = JournalQueue(self._journal_written_cb)
+        self._nick = profile.get_nick_name()
+
+        # Search as you type; see _search_entry_changed_cb
+        self._search_id = None
+        self._filter_id = None
+        self._live_text = None  # query of the last finished live search
+        self._live_expansions = None  # and what its terms expanded to
+
+        # Reflections changed since the last save; see write_file
+        self._store = None
+        self._store_generation = None
+        self._snapshot_needed = True
+        self._dirty = set()
+        self._deleted = set()
+
+        # In-memory SQLite copy of the sort keys, filled by the first
+        # sort and then kept up to date change by change; see _get_db
+        self._db = None
+        self._db_stale = True
+        self._db_dirty = set()
+        self._db_deleted = set()
+
+        self._import_pool = None
+        self._import_queue = Queue.Queue()
+        self._pending_imports = 0
+        self._import_flush_id = None
+        # obj_id -> DSObject being imported; destroying it deletes the
+        # file a worker may still be reading, see _flush_imports
+        self._import_dsobjects = {}
+
+        # Newest Journal timestamp seen by a previous _find_starred
+        self._journal_sync = 0
+        self._pending_journal_sync = 0
+        if self.metadata is not None and 'journal_sync' in self.metadata:
+            try:
+                self._journal_sync = int(self.metadata['journal_sync'])
+            except ValueError:
+                _logger.error('Malformed journal_sync %s' %
+                              self.metadata['journal_sync'])
+
+        self._archives = {}  # incoming picture archive -> [path, offset]
+
+        self._outbox = []
+        self._outbox_id = None
+        self._setup_handlers()
+
+        # Every synced change carries its author and a per-author sequence
+        # number; the vector holds the last number seen from each author.
+        self._sync_author = utils.generate_uid()
+        self._sync_seq = 0
+        self._sync_session = None
+        self._sync_vector = {}
+        self._sync_log = deque()
+        self._sync_floor = {}  # newest seq per author dropped from the log
+        if self.metadata is not None and 'sync_author' in self.metadata:
+            self._sync_author = self.metadata['sync_author']
+            self._sync_session = self.metadata.get('sync_session')
+            try:
+                self._sync_seq = int(self.metadata['sync_seq'])
+                self._sync_vector = json.loads(self.metadata['sync_vector'])
+            except (KeyError, ValueError):
+                _logger.error('Malformed sync state; starting afresh')
+                self._sync_session = None
+                self._sync_vector = {}
 
         self.connect('realize', self.__realize_cb)
 
@@ -113,6 +250,10 @@ class ReflectActivity(activity.Activity):
 
         self.bundle_path = activity.get_bundle_path()
         self.tmp_path = os.path.join(activity.get_activity_root(), 'instance')
+        utils.set_thumbnail_path(os.path.join(activity.get_activity_root(),
+                                              'data', 'thumbnails'))
+        utils.set_image_path(os.path.join(activity.get_activity_root(),
+                                          'data', 'images'))
 
         self.sharing = False
         self._copy_entry = None
@@ -149,29 +290,199 @@ class ReflectActivity(activity.Activity):
             GObject.idle_add(self._load_reflections)
 
     def read_file(self, file_path):
-        fd = open(file_path, 'r')
-        data = fd.read()
-        fd.close()
-        self.reflection_data = json.loads(data)
+        fd = open(file_path, 'rb')
+        try:
+            self.reflection_data = list(reflectstore.read_records(fd))
+        finally:
+            fd.close()
+        # Apply the changes saved to the log since this snapshot
+        store = self._get_store()
+        if self.metadata is not None:
+            self._store_generation = self.metadata.get('store_generation')
+        if store is not None and store.has_snapshot() and \
+           store.replay(self.reflection_data, self._store_generation):
+            self._snapshot_needed = False
+        if self._store_images(self.reflection_data):
+            self._snapshot_needed = True
+        self._rebuild_index()
+
+    def _get_store(self):
+        if self._store is None:
+            try:
+                self._store = reflectstore.ReflectStore(
+                    os.path.join(activity.get_activity_root(), 'data',
+                                 'store'), self.get_id(),
+                    fsync_mode=utils.get_fsync_mode(FSYNC_MODE))
+            except OSError as e:
+                _logger.error('Could not open the reflection store: %s' % e)
+        return self._store
+
+    def mark_dirty(self, obj_id):
+        ''' Save this reflection with the next write_file '''
+        self._dirty.add(obj_id)
+        if self._db is not None:
+            self._db_dirty.add(obj_id)
+        self._field_dirty.add(obj_id)
+        # A changed reflection may now match a query it did not before
+        self._live_text = None
+
+    def _get_db(self):
+        ''' The reflection database, brought up to date with
+        reflection_data, or None if it is not used. It is only imported
+        whole when reflection_data is replaced (see _rebuild_index). '''
+        if not USE_REFLECTION_DB or not reflectdb.HAVE_SQLITE:
+            return None
+        try:
+            if self._db is None:
+                self._db = reflectdb.ReflectionDB(reflectdb.MEMORY)
+            if self._db_stale:
+                self._db.import_records(self.reflection_data)
+            else:
+                for obj_id in self._db_deleted:
+                    self._db.delete(obj_id)
+                for obj_id in self._db_dirty:
+                    item = self.get_item(obj_id)
+                    if item is not None:
+                        # New reflections are added at the top by the
+                        # entry, or at the bottom from the Journal
+                        self._db.put(item, first=len(
+                            self.reflection_data) > 0 and
+                            self.reflection_data[0] is item)
+        except (reflectdb.Error, IOError, OSError) as e:
+            _logger.error('Could not use the reflection database: %s' % e)
+            return None
+        self._db_stale = False
+        self._db_dirty = set()
+        self._db_deleted = set()
+        return self._db
+
+    def _store_images(self, reflection_data, local=True):
+        ''' Point image content at the image store, adding any images
+        that are not yet in it. Images are only added from local data;
+        received paths name files on the sender's machine. Returns True
+        if any content changed. '''
+        changed = False
+        for item in reflection_data:
+            for content in item.get('content', []):
+                if 'image' not in content:
+                    continue
+                digest = content.get('digest')
+                if digest is not None and not utils.is_digest(digest):
+                    logging.error('Ignoring bad image digest %r' % digest)
+                    del content['digest']
+                    digest = None
+                    changed = True
+                if digest is not None and \
+                   (not local or utils.has_image(digest) or
+                    not os.path.exists(content['image'])):
+                    path = utils.find_image(digest)
+                    if content['image'] != path:
+                        content['image'] = path
+                        changed = True
+                elif local and os.path.exists(content['image']):
+                    try:
+                        content['digest'], content['image'] = \
+                            utils.store_image(content['image'])
+                        changed = True
+                    except (IOError, OSError) as e:
+                        logging.error('Could not store %s: %s' %
+                                      (content['image'], e))
+        return changed
 
     def write_file(self, file_path):
-        data = json.dumps(self.reflection_data)
-        fd = open(file_path, 'w')
-        fd.write(data)
-        fd.close()
+        self.journal_queue.flush()
+        store = self._get_store()
+        try:
+            if store is None:
+                raise IOError('No reflection store')
+            if self._snapshot_needed or not store.has_snapshot() or \
+               store.log_size() > LOG_COMPACT_SIZE:
+                # Fold the log into a new snapshot
+                self._store_generation = utils.generate_uid()
+                store.write_snapshot(self.reflection_data,
+                                     self._store_generation)
+            else:
+                # Only the changed reflections are written, to the log;
+                # the Journal keeps the snapshot the log applies to.
+                store.append(self._log_entries())
+            store.copy_snapshot(file_path)
+            self._snapshot_needed = False
+        except (IOError, OSError) as e:
+            _logger.error('Could not save to the reflection store: %s' % e)
+            reflectstore.save_records(file_path, self.reflection_data)
+            self._store_generation = None
+            self._snapshot_needed = True
+        self._dirty = set()
+        self._deleted = set()
 
         self.metadata['font_size'] = str(self.font_size)
+        self.metadata['journal_sync'] = str(self._journal_sync)
+        self.metadata['sync_author'] = self._sync_author
+        self.metadata['sync_seq'] = str(self._sync_seq)
+        self.metadata['sync_vector'] = json.dumps(self._sync_vector)
+        if self._sync_session is not None:
+            self.metadata['sync_session'] = self._sync_session
+        if self._store_generation is not None:
+            self.metadata['store_generation'] = self._store_generation
+        elif 'store_generation' in self.metadata:
+            del self.metadata['store_generation']
+
+    def _log_entries(self):
+        entries = [{'delete': obj_id} for obj_id in self._deleted]
+        # In reflection_data order, so that replay inserts each new
+        # reflection where it is now
+        for index, item in enumerate(self.reflection_data):
+            if item.get('obj_id') in self._dirty:
+                entries.append({'put': item, 'index': index})
+        return entries
+
+    def can_close(self):
+        # A full snapshot on close, so the Journal copy stands alone
+        self._snapshot_needed = True
+        return True
 
     def _load_reflections(self):
-        self._find_starred()
+        bounded = self._find_starred()
         self._reflect_window.load(self.reflection_data)
-        self.reset_cursor()
+        if self._pending_imports > 0:
+            self._flush_imports_later()
+        else:
+            self.reset_cursor()
+        if bounded:
+            GObject.idle_add(self._sweep_journal)
+
+    def _rebuild_index(self):
+        ''' Map each obj_id to its entry in reflection_data '''
+        self._db_stale = True
+        self._obj_id_index = {}
+        for item in self.reflection_data:
+            if 'obj_id' in item:
+                self._obj_id_index[item['obj_id']] = item
+        self.tag_index.rebuild(self.reflection_data)
+        self.text_index.rebuild(self.reflection_data)
+        self._fields_stale = True
+
+    def index_item(self, item):
+        if 'obj_id' in item:
+            self._obj_id_index[item['obj_id']] = item
+            self.tag_index.set_tags(item['obj_id'], item.get('tags', []))
+            self.text_index.index_item(item)
+            self.mark_dirty(item['obj_id'])
+
+    def retag_item(self, item):
+        ''' Index the (changed) tags of item '''
+        if 'obj_id' in item:
+            self.tag_index.set_tags(item['obj_id'], item.get('tags', []))
+
+    def reindex_text(self, item):
+        ''' Index the (changed) title, text and comments of item '''
+        self.text_index.index_item(item)
+
+    def get_item(self, obj_id):
+        return self._obj_id_index.get(obj_id)
 
     def _found_obj_id(self, obj_id):
-        for item in self.reflection_data:
-            if 'obj_id' in item and item['obj_id'] == obj_id:
-                return True
-        return False
+        return obj_id in self._obj_id_index
 
     def reload_data(self, data):
         ''' Reload data after sorting or searching '''
@@ -180,94 +491,305 @@ class ReflectActivity(activity.Activity):
         self.reset_scrolled_window_adjustments()
 
     def _find_starred(self):
-        ''' Find all the _stars in the Journal. '''
-        self.dsobjects, self._nobjects = datastore.find({'keep': '1'})
-        for dsobj in self.dsobjects:
+        ''' Find the _stars in the Journal. When reflections were
+        restored from the instance file, only entries whose timestamp
+        moved since the last look are asked for, and _sweep_journal
+        catches the rest once the window is up. New entries are decoded
+        by worker threads and handed to _flush_imports in batches.
+        Returns True if the query was bounded by the timestamp. '''
+        query = {'keep': '1'}
+        bounded = self._journal_sync > 0 and len(self.reflection_data) > 0
+        if bounded:
+            query['timestamp'] = {'start': self._journal_sync,
+                                  'end': sys.maxint}
+        dsobjects, nobjects = datastore.find(
+            query, properties=JOURNAL_PROPERTIES)
+        newest = self._journal_sync
+        for dsobj in dsobjects:
+            newest = max(newest, self._get_timestamp(dsobj))
+            self._sync_from_journal(dsobj)
+        self._close_import_pool()
+        # Don't advance past entries that are still being imported
+        if self._pending_imports > 0:
+            self._pending_journal_sync = newest
+        else:
+            self._journal_sync = newest
+        return bounded
+
+    def _sweep_journal(self):
+        ''' The fallback for the timestamp-bounded query: a light query
+        over every starred entry finds, by fingerprint, those starred or
+        edited without a new timestamp. New ones are fetched
+        JOURNAL_SWEEP_CHUNK at a time by _fetch_journal_cb. '''
+        dsobjects, nobjects = datastore.find(
+            {'keep': '1'}, properties=JOURNAL_INDEX_PROPERTIES)
+        missing = []
+        for dsobj in dsobjects:
             if self._found_obj_id(dsobj.object_id):
-                continue  # Already have this object -- TODO: update it
-            self._add_new_from_journal(dsobj)
-
-    def _add_new_from_journal(self, dsobj):
-        self.reflection_data.append({
-            'title': _('Untitled'), 'obj_id': dsobj.object_id})
-        if hasattr(dsobj, 'metadata'):
-            if 'creation_time' in dsobj.metadata:
-                self.reflection_data[-1]['creation_time'] = \
-                    dsobj.metadata['creation_time']
+                self._sync_from_journal(dsobj)
             else:
-                self.reflection_data[-1]['creation_time'] = \
-                    int(time.time())
-            if 'timestamp' in dsobj.metadata:
-                self.reflection_data[-1]['modification_time'] = \
-                    dsobj.metadata['timestamp']
+                if dsobj.object_id not in self._import_dsobjects:
+                    missing.append(dsobj.object_id)
+                dsobj.destroy()
+        if len(missing) > 0:
+            GObject.idle_add(self._fetch_journal_cb, missing)
+        return False
+
+    def _fetch_journal_cb(self, missing):
+        for obj_id in missing[:JOURNAL_SWEEP_CHUNK]:
+            try:
+                dsobjects, nobjects = datastore.find(
+                    {'uid': obj_id}, properties=JOURNAL_PROPERTIES)
+            except Exception as e:
+                _logger.error('Could not find %s: %s' % (obj_id, e))
+                continue
+            for dsobj in dsobjects:
+                self._sync_from_journal(dsobj)
+        del missing[:JOURNAL_SWEEP_CHUNK]
+        self._flush_imports_later()
+        if len(missing) > 0:
+            return True
+        self._close_import_pool()
+        return False
+
+    def _sync_from_journal(self, dsobj):
+        ''' Import a new Journal entry, or refresh the reflection of one
+        whose fingerprint changed; dsobj is destroyed once it is done
+        with '''
+        fingerprint = self._journal_fingerprint(dsobj.metadata)
+        item = self.get_item(dsobj.object_id)
+        if item is None:
+            if dsobj.object_id in self._import_dsobjects:
+                dsobj.destroy()  # Already being imported
             else:
-                self.reflection_data[-1]['modification_time'] = \
-                    self.reflection_data[-1]['creation_time']
-            if 'activity' in dsobj.metadata:
-                self.reflection_data[-1]['activities'] = \
-                    [utils.bundle_id_to_icon(dsobj.metadata['activity'])]
-            if 'title' in dsobj.metadata:
-                self.reflection_data[-1]['title'] = \
-                    dsobj.metadata['title']
-            if 'description' in dsobj.metadata:
-                self.reflection_data[-1]['content'] = \
-                    [{'text': dsobj.metadata['description']}]
+                self._queue_import(dsobj, fingerprint)
+            return
+        if item.get('journal_fingerprint') != fingerprint:
+            self._update_from_journal(item, dsobj)
+            item['journal_fingerprint'] = fingerprint
+        dsobj.destroy()
+
+    def _get_timestamp(self, dsobj):
+        try:
+            return int(dsobj.metadata['timestamp'])
+        except (KeyError, ValueError):
+            return 0
+
+    def _journal_fingerprint(self, metadata):
+        ''' A digest of the Journal fields a reflection is built from '''
+        return hashlib.sha1(json.dumps(
+            [metadata.get(key) for key in JOURNAL_INDEX_PROPERTIES])
+        ).hexdigest()
+
+    def _journal_written_cb(self, obj_id, metadata):
+        ''' Reflect wrote this Journal entry itself; remember its new
+        fingerprint, so that the change is not read back as a Journal
+        edit '''
+        item = self.get_item(obj_id)
+        if item is not None:
+            item['journal_fingerprint'] = self._journal_fingerprint(metadata)
+            self.mark_dirty(obj_id)
+
+    def _queue_import(self, dsobj, fingerprint):
+        if self._import_pool is None:
+            self._import_pool = ThreadPool(IMPORT_WORKERS)
+        metadata, file_path, icon = self._journal_snapshot(dsobj)
+        self._import_dsobjects[dsobj.object_id] = dsobj
+        self._pending_imports += 1
+        self._import_pool.apply_async(
+            self._import_worker,
+            (dsobj.object_id, metadata, file_path, icon, fingerprint),
+            callback=self._import_queue.put)
+
+    def _close_import_pool(self):
+        ''' Let the workers finish what is queued, then exit '''
+        if self._import_pool is not None:
+            self._import_pool.close()
+            self._import_pool = None
+
+    def _flush_imports_later(self):
+        if self._pending_imports > 0 and self._import_flush_id is None:
+            self._import_flush_id = GObject.timeout_add(
+                IMPORT_FLUSH_INTERVAL, self._flush_imports)
+
+    def _journal_snapshot(self, dsobj):
+        ''' Everything a worker needs, fetched here since the datastore
+        must only be called from the main thread. The activity icon is
+        looked up here too: the bundle table is filled on first use,
+        without a lock. '''
+        if not hasattr(dsobj, 'metadata'):
+            return None, None, None
+        metadata = dsobj.metadata.get_dictionary().copy()
+        file_path = None
+        if metadata.get('mime_type', '')[0:5] == 'image':
+            file_path = dsobj.file_path
+        icon = None
+        if 'activity' in metadata:
+            icon = utils.bundle_id_to_icon(metadata['activity'])
+        return metadata, file_path, icon
+
+    def _import_worker(self, object_id, metadata, file_path, icon,
+                       fingerprint):
+        try:
+            item = self._reflection_from_journal(
+                object_id, metadata, file_path, icon)
+            item['journal_fingerprint'] = fingerprint
+            return object_id, item
+        except Exception as e:
+            _logger.error('Could not import %s: %s' % (object_id, e))
+            return object_id, None
+
+    def _flush_imports(self):
+        ''' Add imported reflections to the window, a batch at a time '''
+        start_time = time.time()
+        batch = []
+        while time.time() - start_time < IMPORT_FRAME_BUDGET:
+            try:
+                object_id, item = self._import_queue.get_nowait()
+            except Queue.Empty:
+                break
+            self._pending_imports -= 1
+            dsobj = self._import_dsobjects.pop(object_id, None)
+            if dsobj is not None:
+                dsobj.destroy()
+            if item is None or self._found_obj_id(item['obj_id']):
+                continue
+            self.reflection_data.append(item)
+            self.index_item(item)
+            batch.append(item)
+        if len(batch) > 0:
+            self._reflect_window.add_items(batch)
+
+        if self._pending_imports > 0:
+            return True
+        self._import_flush_id = None
+        if self._pending_journal_sync > self._journal_sync:
+            self._journal_sync = self._pending_journal_sync
+        self.reset_cursor()
+        return False
+
+    def _tags_from_journal(self, metadata):
+        tags = []
+        for tag in metadata['tags'].split():
+            # _process_tags writes them as '#a, #b'
+            tag = tag.rstrip(',')
+            tag = tag.rstrip(';')
+            if len(tag) == 0:
+                continue
+            if tag[0] != '#':
+                tags.append('#' + tag)
             else:
-                self.reflection_data[-1]['content'] = []
-            if 'tags' in dsobj.metadata:
-                self.reflection_data[-1]['tags'] = []
-                tags = dsobj.metadata['tags'].split()
-                for tag in tags:
-                    if tag[0] != '#':
-                        self.reflection_data[-1]['tags'].append('#' + tag)
-                    else:
-                        self.reflection_data[-1]['tags'].append(tag)
-            if 'comments' in dsobj.metadata:
-                try:
-                    comments = json.loads(dsobj.metadata['comments'])
-                except:
-                    comments = []
-                self.reflection_data[-1]['comments'] = []
-                for comment in comments:
-                    try:
-                        data = {'nick': comment['from'],
-                                'comment': comment['message']}
-                        if 'icon-color' in comment:
-                            colors = comment['icon-color'].split(',')
-                            darker = 1 - utils.lighter_color(colors)
-                            data['color'] = colors[darker]
-                        else:
-                            data['color'] = '#000000'
-                        self.reflection_data[-1]['comments'].append(data)
-                    except:
-                        _logger.debug('could not parse comment %s'
-                                      % comment)
-            if 'mime_type' in dsobj.metadata and \
-               dsobj.metadata['mime_type'][0:5] == 'image':
-                new_path = os.path.join(self.tmp_path,
-                                        dsobj.object_id)
-                try:
-                    shutil.copy(dsobj.file_path, new_path)
-                except Exception as e:
-                    logging.error("Couldn't copy %s to %s: %s" %
-                                  (dsobj.file_path, new_path, e))
-                self.reflection_data[-1]['content'].append(
-                    {'image': new_path})
-            elif 'preview' in dsobj.metadata:
-                pixbuf = utils.get_pixbuf_from_journal(dsobj, 300, 225)
-                if pixbuf is not None:
-                    path = os.path.join(self.tmp_path,
-                                        dsobj.object_id + '.png')
-                    utils.save_pixbuf_to_file(pixbuf, path)
-                    self.reflection_data[-1]['content'].append(
-                        {'image': path})
-            self.reflection_data[-1]['stars'] = 0
+                tags.append(tag)
+        return tags
+
+    def _comments_from_journal(self, metadata):
+        try:
+            comments = json.loads(metadata['comments'])
+        except:
+            comments = []
+        data = []
+        for comment in comments:
+            try:
+                entry = {'nick': comment['from'],
+                         'comment': comment['message']}
+                if 'icon-color' in comment:
+                    colors = comment['icon-color'].split(',')
+                    darker = 1 - utils.lighter_color(colors)
+                    entry['color'] = colors[darker]
+                else:
+                    entry['color'] = '#000000'
+                data.append(entry)
+            except:
+                _logger.debug('could not parse comment %s' % comment)
+        return data
+
+    def _update_from_journal(self, item, dsobj):
+        ''' Refresh a reflection from its (changed) Journal entry '''
+        if not hasattr(dsobj, 'metadata'):
+            return
+        self.journal_queue.forget(item['obj_id'])
+        self.mark_dirty(item['obj_id'])
+        if 'timestamp' in dsobj.metadata:
+            item['modification_time'] = dsobj.metadata['timestamp']
+        if 'title' in dsobj.metadata:
+            item['title'] = dsobj.metadata['title']
+        if 'tags' in dsobj.metadata:
+            item['tags'] = self._tags_from_journal(dsobj.metadata)
+            self.retag_item(item)
+        if 'comments' in dsobj.metadata:
+            item['comments'] = self._comments_from_journal(dsobj.metadata)
+        self.reindex_text(item)
+        # Cards already built show the change too
+        self._reflect_window.update_title(item['obj_id'], item['title'])
+        if 'tags' in item:
+            self._reflect_window.update_tags(item['obj_id'],
+                                             json.dumps(item['tags']))
+
+    def _add_new_from_journal(self, dsobj):
+        metadata, file_path, icon = self._journal_snapshot(dsobj)
+        self.reflection_data.append(self._reflection_from_journal(
+            dsobj.object_id, metadata, file_path, icon))
+        self.index_item(self.reflection_data[-1])
+
+    def _reflection_from_journal(self, object_id, metadata, file_path,
+                                 icon):
+        ''' Build a reflection from a snapshot of Journal metadata (see
+        _journal_snapshot). This runs in the import workers, so it must
+        not touch the datastore, the bundle table or any widgets. '''
+        # Journal entries are the learner's own
+        item = {'title': _('Untitled'), 'obj_id': object_id,
+                'nick': self._nick}
+        if metadata is None:
+            return item
+        if 'creation_time' in metadata:
+            item['creation_time'] = metadata['creation_time']
+        else:
+            item['creation_time'] = int(time.time())
+        if 'timestamp' in metadata:
+            item['modification_time'] = metadata['timestamp']
+        else:
+            item['modification_time'] = item['creation_time']
+        if icon is not None:
+            item['activities'] = [icon]
+        if 'title' in metadata:
+            item['title'] = metadata['title']
+        if 'description' in metadata:
+            item['content'] = [{'text': metadata['description']}]
+        else:
+            item['content'] = []
+        if 'tags' in metadata:
+            item['tags'] = self._tags_from_journal(metadata)
+        if 'comments' in metadata:
+            item['comments'] = self._comments_from_journal(metadata)
+        if metadata.get('mime_type', '')[0:5] == 'image':
+            try:
+                digest, path = utils.store_image(file_path)
+                item['content'].append({'image': path, 'digest': digest})
+            except Exception as e:
+                logging.error("Couldn't store %s: %s" % (file_path, e))
+        elif 'preview' in metadata:
+            pixbuf = utils.get_pixbuf_from_preview(
+                metadata['preview'], 300, 225)
+            if pixbuf is not None:
+                digest, path = utils.store_image_data(utils.pixbuf_to_png(
+                    pixbuf, pixbuf.get_width(), pixbuf.get_height()))
+                item['content'].append({'image': path, 'digest': digest})
+        item['stars'] = 0
+        return item
 
     def delete_item(self, obj_id):
-        for i, obj in enumerate(self.reflection_data):
-            if obj['obj_id'] == obj_id:
-                self.reflection_data.remove(self.reflection_data[i])
-                return
+        item = self._obj_id_index.pop(obj_id, None)
+        if item is not None:
+            self.reflection_data.remove(item)
+        self.tag_index.remove(obj_id)
+        self.text_index.remove(obj_id)
+        self._field_dirty.add(obj_id)
+        self.journal_queue.forget(obj_id)
+        self._dirty.discard(obj_id)
+        self._deleted.add(obj_id)
+        if self._db is not None:
+            self._db_dirty.discard(obj_id)
+            self._db_deleted.add(obj_id)
 
     def busy_cursor(self):
         self.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
@@ -343,6 +865,9 @@ class ReflectActivity(activity.Activity):
         if adj is not None:
             adj.set_value(0)
 
+    def get_vadjustment(self):
+        return self._scrolled_window.get_vadjustment()
+
     def load_graphics_area(self, widget):
         self._graphics_area.add(widget)
 
@@ -552,41 +1077,252 @@ class ReflectActivity(activity.Activity):
         self.busy_cursor()
         self._do_search()
 
+    def _search_tags(self):
+        ''' The tags searched for, or None if there is no search '''
+        if self._search_entry.props.text == '':
+            return None
+        tags = self._search_entry.props.text.split()
+        for i, tag in enumerate(tags):
+            if not tag[0] == '#':
+                tags[i] = '#%s' % tag
+        return tags
+
+    def _search_results(self, expansions):
+        ''' The obj_ids with a matched tag, and those with a matched word
+        in their text, best match first; the order of the matches '''
+        tags = []
+        words = []
+        for term_tags, term_words in expansions.values():
+            tags.extend(term_tags)
+            words.extend(term_words)
+        tagged = self.tag_index.any_of(tags)
+        ranked = [obj_id for obj_id in self.text_index.search(' '.join(words))
+                  if obj_id not in tagged]
+        return tagged, ranked
+
+    def _expand_terms(self, terms, previous=None):
+        ''' Match the terms of a search through the tag and text indexes:
+        a '#' term expands to the tags it starts, any other term to the
+        tags its '#' form starts and the words it starts. A reflection
+        matches if it has any of them, as match_any_prefix would say.
+        This is a generator, so that the live search can run it an idle
+        call at a time; it yields None every SEARCH_CHUNK_SIZE tags or
+        words, then (obj_ids, expansions). expansions maps each term to
+        its (tags, words); a term that extends one of a previous search
+        is only checked against what that one expanded to. '''
+        expansions = {}
+        for term in terms:
+            if term in expansions:
+                continue
+            base = None
+            for old in (previous or {}):
+                if term.startswith(old) and \
+                   (base is None or len(old) > len(base)):
+                    base = old
+            if base is not None:
+                tags, words = previous[base]
+            else:
+                tags = self.tag_index.tags()
+                words = self.text_index.vocabulary()
+            if term[0] == '#':
+                tag_term = term
+                words = []
+            else:
+                tag_term = '#' + term
+            matched_tags = []
+            for start in range(0, len(tags), SEARCH_CHUNK_SIZE):
+                matched_tags.extend([tag for tag in
+                                     tags[start:start + SEARCH_CHUNK_SIZE]
+                                     if tag.startswith(tag_term)])
+                yield None
+            matched_words = []
+            for start in range(0, len(words), SEARCH_CHUNK_SIZE):
+                matched_words.extend([word for word in
+                                      words[start:start + SEARCH_CHUNK_SIZE]
+                                      if word.startswith(term)])
+                yield None
+            expansions[term] = (matched_tags, matched_words)
+        obj_ids = set()
+        for tags, words in expansions.values():
+            obj_ids |= self.tag_index.any_of(tags)
+            obj_ids |= self.text_index.any_of(words)
+        yield obj_ids, expansions
+
+    def _search_now(self, terms):
+        ''' Run _expand_terms to the end '''
+        for result in self._expand_terms(terms):
+            pass
+        return result
+
+    def _query_results(self):
+        ''' obj_ids matching the search if it is written in the query
+        language (see searchindex.parse_query), otherwise None '''
+        text = self._search_entry.props.text
+        if not is_query(text):
+            return None
+        try:
+            query = parse_query(text)
+        except QueryError as e:
+            _logger.error('Could not parse query %s: %s' % (text, e))
+            return None
+        self._update_field_index()
+        return evaluate(query, self._query_lookup, self._obj_id_index)
+
+    def _update_field_index(self):
+        if self._fields_stale:
+            self.field_index.rebuild(self.reflection_data)
+        else:
+            for obj_id in self._field_dirty:
+                item = self.get_item(obj_id)
+                if item is None:
+                    self.field_index.remove(obj_id)
+                else:
+                    self.field_index.index_item(item)
+        self._fields_stale = False
+        self._field_dirty = set()
+
+    def _query_lookup(self, term):
+        ''' The obj_ids matching one term of a query '''
+        kind = term[0]
+        if kind == 'tag':
+            return self.tag_index.any_of([term[1]])
+        elif kind == 'word':
+            return self.tag_index.any_of(['#' + term[1]]) | \
+                self.text_index.lookup(term[1])
+        elif kind == 'stars':
+            return self.field_index.stars(term[1], term[2])
+        elif kind == 'before':
+            return self.field_index.modified(before=term[1])
+        elif kind == 'after':
+            return self.field_index.modified(after=term[1])
+        elif kind == 'activity':
+            return self.field_index.activities(
+                [utils.bundle_id_to_icon(term[1])], term[1])
+        elif kind == 'by':
+            return self.field_index.authors(term[1])
+        return set()
+
+    def _matches_terms(self, item, terms, matched=None):
+        ''' Whether item matches the search: by the obj_ids from
+        _expand_terms if given, otherwise, for reflections without an
+        obj_id or only a few, by checking its own tags and words '''
+        if matched is not None and 'obj_id' in item:
+            return item['obj_id'] in matched
+        if 'obj_id' in item:
+            words = self.text_index.words(item['obj_id'])
+        else:
+            words = []
+        return match_any_prefix(terms, words, item.get('tags', []))
+
     def _do_search(self):
         logging.debug('_search_entry_activated_cb')
-        if self._search_entry.props.text == '':
+        self._cancel_live_search()
+        self._live_text = None  # Its hidden flags are replaced below
+        tags = self._search_tags()
+        matched = None
+        if tags is not None:
+            matched = self._query_results()
+        if tags is None:
             logging.debug('clearing search')
             for item in self.reflection_data:
                 item['hidden'] = False
+            data = self.reflection_data
+        elif matched is not None:
+            for item in self.reflection_data:
+                item['hidden'] = item.get('obj_id') not in matched
+            data = self.reflection_data
         else:
-            tags = self._search_entry.props.text.split()
-            for i, tag in enumerate(tags):
-                if not tag[0] == '#':
-                    tags[i] = '#%s' % tag
-            logging.error(tags)
+            terms = prefix_terms(self._search_entry.props.text)
+            matched, expansions = self._search_now(terms)
+            tagged, ranked = self._search_results(expansions)
+            rank = dict([(obj_id, i) for i, obj_id in enumerate(ranked)])
             for item in self.reflection_data:
-                hidden = True
-                if 'tags' in item:
-                    for tag in tags:
-                        if tag in item['tags']:
-                            hidden = False
-                item['hidden'] = hidden
-        self.reload_data(self.reflection_data)
+                item['hidden'] = not self._matches_terms(item, terms,
+                                                         matched)
+
+            # Tag matches first, then text matches by rank
+            def search_order(item):
+                obj_id = item.get('obj_id')
+                if obj_id in tagged:
+                    return -1
+                return rank.get(obj_id, len(rank))
+
+            data = sorted(self.reflection_data, key=search_order)
+        self.reload_data(data)
         self.reset_cursor()
 
     def _search_entry_changed_cb(self, entry):
         logging.debug('_search_entry_changed_cb search for \'%s\'',
                      self._search_entry.props.text)
-        self.busy_cursor()
-        self._do_search_changed()
+        self._cancel_live_search()
+        if self._search_entry.props.text == '':
+            self._do_search_changed()
+        else:
+            # Wait for a pause in the typing
+            self._search_id = GObject.timeout_add(SEARCH_DELAY,
+                                                  self._search_timeout_cb)
 
     def _do_search_changed(self):
         if self._search_entry.props.text == '':
             logging.debug('clearing search')
+            self._live_text = None
             for item in self.reflection_data:
                 item['hidden'] = False
             self.reload_data(self.reflection_data)
-        self.reset_cursor()
+
+    def _cancel_live_search(self):
+        ''' Drop a pending live search and any filtering in progress '''
+        if self._search_id is not None:
+            GObject.source_remove(self._search_id)
+            self._search_id = None
+        if self._filter_id is not None:
+            GObject.source_remove(self._filter_id)
+            self._filter_id = None
+
+    def _search_timeout_cb(self):
+        self._search_id = None
+        text = self._search_entry.props.text
+        if is_query(text):
+            # Queries are answered from the indexes, without a scan
+            self._do_search()
+            return False
+        previous = None
+        if self._live_text is not None and text.startswith(self._live_text):
+            # The query only grew, so its terms expand to what the last
+            # ones did, or less
+            previous = self._live_expansions
+        task = self._live_filter(text, prefix_terms(text), previous)
+        self._filter_id = GObject.idle_add(self._live_filter_cb, task)
+        return False
+
+    def _live_filter_cb(self, task):
+        try:
+            return next(task)
+        except StopIteration:
+            self._filter_id = None
+            return False
+
+    def _live_filter(self, text, terms, previous):
+        ''' Match terms through the indexes as _do_search does, then set
+        the hidden flags, SEARCH_CHUNK_SIZE at a time, yielding to the
+        main loop in between. The window is only reloaded if a flag
+        changed. '''
+        for result in self._expand_terms(terms, previous):
+            if result is None:
+                yield True
+        matched, expansions = result
+        changed = False
+        for start in range(0, len(self.reflection_data), SEARCH_CHUNK_SIZE):
+            for item in self.reflection_data[start:start + SEARCH_CHUNK_SIZE]:
+                hidden = not self._matches_terms(item, terms, matched)
+                if item.get('hidden', False) != hidden:
+                    item['hidden'] = hidden
+                    changed = True
+            yield True
+        self._live_text = text
+        self._live_expansions = expansions
+        if changed:
+            self.reload_data(self.reflection_data)
 
     def _title_button_cb(self, button):
         ''' sort by title '''
@@ -594,8 +1330,10 @@ class ReflectActivity(activity.Activity):
         GObject.idle_add(self._title_sort)
 
     def _title_sort(self):
-        sorted_data = sorted(self.reflection_data,
-                             key=lambda item: item['title'].lower())
+        sorted_data = self._db_sort('title')
+        if sorted_data is None:
+            sorted_data = sorted(self.reflection_data,
+                                 key=lambda item: item['title'].lower())
         self.reload_data(sorted_data)
         self.reset_cursor()
 
@@ -605,9 +1343,12 @@ class ReflectActivity(activity.Activity):
         GObject.idle_add(self._date_sort)
 
     def _date_sort(self):
-        sorted_data = sorted(self.reflection_data,
-                             key=lambda item: int(item['modification_time']),
-                             reverse=True)
+        sorted_data = self._db_sort('date')
+        if sorted_data is None:
+            sorted_data = sorted(
+                self.reflection_data,
+                key=lambda item: int(item['modification_time']),
+                reverse=True)
         self.reload_data(sorted_data)
         self.reset_cursor()
 
@@ -617,11 +1358,28 @@ class ReflectActivity(activity.Activity):
         GObject.idle_add(self._stars_sort)
 
     def _stars_sort(self):
-        sorted_data = sorted(self.reflection_data,
-                             key=lambda item: item['stars'], reverse=True)
+        sorted_data = self._db_sort('stars')
+        if sorted_data is None:
+            sorted_data = sorted(self.reflection_data,
+                                 key=lambda item: item['stars'], reverse=True)
         self.reload_data(sorted_data)
         self.reset_cursor()
 
+    def _db_sort(self, order):
+        ''' reflection_data sorted by the database, or None if there is no
+        database. Only the obj_ids come back from it; the window builds
+        cards for the visible rows alone. '''
+        db = self._get_db()
+        if db is None:
+            return None
+        sorted_data = [self.get_item(obj_id) for obj_id in
+                       db.sorted_ids(order)]
+        sorted_data = [item for item in sorted_data if item is not None]
+        # Reflections the database does not hold go last
+        sorted_data.extend([item for item in self.reflection_data
+                            if 'obj_id' not in item])
+        return sorted_data
+
     def __realize_cb(self, window):
         self.window_xid = window.get_window().get_xid()
 
@@ -723,6 +1481,12 @@ class ReflectActivity(activity.Activity):
         self._waiting_for_reflections = False
         _logger.debug('I am sharing...')
 
+        # A new session: buddies from an earlier one get a full share
+        self._sync_session = utils.generate_uid()
+        self._sync_vector = {}
+        self._sync_log.clear()
+        self._sync_floor = {}
+
         self.conn = self.shared_activity.telepathy_conn
         self.tubes_chan = self.shared_activity.telepathy_tubes_chan
         self.text_chan = self.shared_activity.telepathy_text_chan
@@ -787,152 +1551,398 @@ class ReflectActivity(activity.Activity):
 
             self.collab = CollabWrapper(self)
             self.collab.message.connect(self.event_received_cb)
+            self.collab.incoming_file.connect(self._incoming_file_cb)
             self.collab.setup()
 
             if self._waiting_for_reflections:
-                self.send_event(JOIN_CMD, {})
+                # Ask for the pictures we lack as a single archive transfer
+                self.send_event(JOIN_CMD,
+                                {"bulk": True,
+                                 "digests": utils.get_image_digests(),
+                                 "session": self._sync_session,
+                                 "vector": self._sync_vector})
                 self._joined_alert = Alert()
                 self._joined_alert.props.title = _('Please wait')
                 self._joined_alert.props.msg = _('Requesting reflections...')
                 self.add_alert(self._joined_alert)
 
+    def _setup_handlers(self):
+        ''' Handlers for received commands. Those in _item_handlers act on
+        one reflection, which is looked up by obj_id before the call. '''
+        self._handlers = {
+            JOIN_CMD: self._join_received,
+            SHARE_CMD: self._share_received,
+            SYNC_CMD: self._sync_received,
+            BATCH_CMD: self._batch_received,
+            PICTURE_CMD: self._picture_received,
+            NEW_REFLECTION_CMD: self._new_reflection_received,
+        }
+        self._item_handlers = {
+            TITLE_CMD: self._title_received,
+            TAG_CMD: self._tag_received,
+            ACTIVITY_CMD: self._activity_received,
+            STAR_CMD: self._star_received,
+            COMMENT_CMD: self._comment_received,
+            REFLECTION_CMD: self._reflection_received,
+            IMAGE_REFLECTION_CMD: self._image_reflection_received,
+        }
+        self._received_items = set()
+
     def event_received_cb(self, collab, buddy, msg):
         ''' Data is passed as tuples: cmd:text '''
+        self._dispatch(collab, buddy, msg)
+        self._refresh_received()
+
+    def _dispatch(self, collab, buddy, msg):
         command = msg.get("command")
-        payload = msg.get("payload")
+        # send_event posts the payload fields alongside the command
+        payload = msg.get("payload", msg)
         logging.debug(command)
 
-        if command == JOIN_CMD:
-            # Sharer needs to send reflections database to joiners.
-            if self.initiating:
-                # Send pictures first.
-                for item in self.reflection_data:
-                    if 'content' in item:
-                        for content in item['content']:
-                            if 'image' in content:
-                                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                                    content['image'], 120, 90)
-                                if pixbuf is not None:
-                                    data = utils.pixbuf_to_base64(pixbuf)
-                                self.send_event(PICTURE_CMD,
-                                    {"image": os.path.basename(content['image']),
-                                     "data": data})
-                data = json.dumps(self.reflection_data)
-                self.send_event(SHARE_CMD, {"data": data})
-        elif command == NEW_REFLECTION_CMD:
-            self._reflect_window.add_new_reflection(payload)
-        elif command == TITLE_CMD:
-            obj_id = payload.get("obj_id")
-            title = payload.get("title")
-            for item in self.reflection_data:
-                if item['obj_id'] == obj_id:
-                    found_the_object = True
-                    self._reflect_window.update_title(obj_id, title)
-                    break
-            if not found_the_object:
-                logging.error('Could not find obj_id %s' % obj_id)
-        elif command == TAG_CMD:
-            obj_id = payload.get("obj_id")
-            data = payload.get("data")
-            for item in self.reflection_data:
-                if item['obj_id'] == obj_id:
-                    found_the_object = True
-                    self._reflect_window.update_tags(obj_id, data)
-                    break
-            if not found_the_object:
-                logging.error('Could not find obj_id %s' % obj_id)
-        elif command == ACTIVITY_CMD:
-            obj_id = payload.get("obj_id")
-            bundle_id = payload.get("bundle_id")
-            for item in self.reflection_data:
-                if item['obj_id'] == obj_id:
-                    found_the_object = True
-                    self._reflect_window.insert_activity(obj_id, bundle_id)
-                    break
-            if not found_the_object:
-                logging.error('Could not find obj_id %s' % obj_id)
-        elif command == STAR_CMD:
-            obj_id = payload.get("obj_id")
-            stars = payload.get("stars")
-            for item in self.reflection_data:
-                if item['obj_id'] == obj_id:
-                    found_the_object = True
-                    self._reflect_window.update_stars(obj_id, int(stars))
-                    break
-            if not found_the_object:
-                logging.error('Could not find obj_id %s' % obj_id)
-        elif command == COMMENT_CMD:
-            found_the_object = False
-            # Receive a comment and associated reflection ID
-            obj_id = payload.get("obj_id")
-            nick = payload.get("nick")
-            color = payload.get("color")
-            comment = payload.get("comment")
-            for item in self.reflection_data:
-                if item['obj_id'] == obj_id:
-                    found_the_object = True
-                    if not 'comments' in item:
-                        item['comments'] = []
-                    data = {'nick': nick, 'comment': comment, 'color': color}
-                    item['comments'].append(data)
-                    self._reflect_window.insert_comment(obj_id, data)
-                    break
-            if not found_the_object:
-                logging.error('Could not find obj_id %s' % obj_id)
-        elif command == REFLECTION_CMD:
-            found_the_object = False
-            # Receive a reflection and associated reflection ID
-            obj_id = payload.get("obj_id")
-            reflection = payload.get("reflection")
-            for item in self.reflection_data:
-                if item['obj_id'] == obj_id:
-                    found_the_object = True
-                    if not '' in item:
-                        item['content'] = []
-                    item['content'].append({'text': reflection})
-                    self._reflect_window.insert_reflection(obj_id, reflection)
-                    break
-            if not found_the_object:
-                logging.error('Could not find obj_id %s' % obj_id)
-        elif command == IMAGE_REFLECTION_CMD:
-            found_the_object = False
-            # Receive a picture reflection and associated reflection ID
+        if payload.get("seq") is not None and not self._record_op(payload):
+            return  # Already applied
+
+        if command in self._item_handlers:
             obj_id = payload.get("obj_id")
-            basename = payload.get("basename")
-            for item in self.reflection_data:
-                if item['obj_id'] == obj_id:
-                    found_the_object = True
-                    if not '' in item:
-                        item['content'] = []
-                    item['content'].append(
-                        {'image': os.path.join(self.tmp_path, basename)})
-                    self._reflect_window.insert_picture(
-                        obj_id, os.path.join(self.tmp_path, basename))
-                    break
-            if not found_the_object:
+            item = self.get_item(obj_id)
+            if item is None:
                 logging.error('Could not find obj_id %s' % obj_id)
-        elif command == PICTURE_CMD:
-            # Receive a picture (MAYBE DISPLAY IT AS IT ARRIVES?)
-            basename = payload.get("basename")
-            data = payload.get("data")
-            utils.base64_to_file(data, os.path.join(self.tmp_path, basename))
-        elif command == SHARE_CMD:
-            # Joiner needs to load reflection database.
-            if not self.initiating:
-                # Note that pictures should be received.
-                self.reflection_data = payload
-                self._reflect_window.load(self.reflection_data)
-                self._waiting_for_reflections = False
-                self.reset_cursor()
-                if self._joined_alert is not None:
-                    self.remove_alert(self._joined_alert)
-                    self._joined_alert = None
+                return
+            self._item_handlers[command](item, payload)
+            if command in TEXT_COMMANDS:
+                self.reindex_text(item)
+            self._received_items.add(obj_id)
+            self.mark_dirty(obj_id)
+        elif command in self._handlers:
+            self._handlers[command](collab, buddy, payload)
+        else:
+            logging.error('Unknown command %s' % command)
+
+    def _refresh_received(self):
+        ''' Bring the reflections changed by received commands in line
+        with the current search, once per message '''
+        if len(self._received_items) == 0:
+            return
+        if self._search_tags() is not None:
+            matched = self._query_results()
+            terms = prefix_terms(self._search_entry.props.text)
+            for obj_id in self._received_items:
+                item = self.get_item(obj_id)
+                if item is None:
+                    continue
+                if matched is not None:
+                    item['hidden'] = obj_id not in matched
+                else:
+                    item['hidden'] = not self._matches_terms(item, terms)
+        self._reflect_window.refresh_items(self._received_items)
+        self._received_items = set()
+
+    def _join_received(self, collab, buddy, payload):
+        # Sharer needs to send reflections database to joiners.
+        if not self.initiating:
+            return
+        held = set(payload.get("digests", []))
+        if payload.get("bulk") and buddy is not None:
+            self._send_picture_archive(buddy, held)
+        else:
+            # Send pictures first.
+            for digest, basename, data in self._picture_thumbnails(held):
+                self.send_event(PICTURE_CMD,
+                                {"basename": basename,
+                                 "digest": digest,
+                                 "data": base64.b64encode(data)})
+        # A buddy rejoining this session only needs the ops it missed
+        ops = None
+        if payload.get("session") == self._sync_session:
+            ops = self._missing_ops(payload.get("vector", {}))
+        if ops is not None:
+            self.send_event(SYNC_CMD, {"session": self._sync_session,
+                                       "ops": ops})
+        else:
+            data = json.dumps(self.reflection_data)
+            self.send_event(SHARE_CMD, {"data": data,
+                                        "session": self._sync_session,
+                                        "vector": self._sync_vector})
+
+    def _batch_received(self, collab, buddy, payload):
+        for op in payload.get("ops", []):
+            self._dispatch(collab, buddy, op)
+
+    def _sync_received(self, collab, buddy, payload):
+        # Joiner replays the ops it missed onto the data it has.
+        if self.initiating or payload.get("session") != self._sync_session:
+            return
+        if self._waiting_for_reflections:
+            self._reflect_window.load(self.reflection_data)
+        self._batch_received(collab, buddy, payload)
+        self._reflections_received()
+
+    def _new_reflection_received(self, collab, buddy, payload):
+        item = self._reflect_window.add_new_reflection(payload.get("data"))
+        if 'obj_id' in item:
+            self._received_items.add(item['obj_id'])
+
+    def _title_received(self, item, payload):
+        self._reflect_window.update_title(item['obj_id'],
+                                          payload.get("title"))
+
+    def _tag_received(self, item, payload):
+        self._reflect_window.update_tags(item['obj_id'], payload.get("data"))
+
+    def _activity_received(self, item, payload):
+        self._reflect_window.insert_activity(item['obj_id'],
+                                             payload.get("bundle_id"))
+
+    def _star_received(self, item, payload):
+        self._reflect_window.update_stars(item['obj_id'],
+                                          int(payload.get("stars")),
+                                          payload.get("count"))
+
+    def _comment_received(self, item, payload):
+        # Receive a comment and associated reflection ID
+        if not 'comments' in item:
+            item['comments'] = []
+        data = {'nick': payload.get("nick"),
+                'comment': payload.get("comment"),
+                'color': payload.get("color")}
+        item['comments'].append(data)
+        self._reflect_window.insert_comment(item['obj_id'], data)
+
+    def _reflection_received(self, item, payload):
+        # Receive a reflection and associated reflection ID
+        reflection = payload.get("reflection")
+        if not 'content' in item:
+            item['content'] = []
+        item['content'].append({'text': reflection})
+        self._reflect_window.insert_reflection(item['obj_id'], reflection)
+
+    def _image_reflection_received(self, item, payload):
+        # Receive a picture reflection and associated reflection ID
+        digest = payload.get("digest")
+        if utils.is_digest(digest):
+            path = utils.find_image(digest)
+        else:
+            digest = None
+            path = self._received_path(payload.get("basename"))
+            if path is None:
+                return
+        # insert_picture adds the image to the reflection data
+        self._reflect_window.insert_picture(item['obj_id'], path, digest)
+
+    def _picture_received(self, collab, buddy, payload):
+        # Receive a picture (MAYBE DISPLAY IT AS IT ARRIVES?)
+        digest = payload.get("digest")
+        data = payload.get("data")
+        if digest is not None:
+            if not utils.is_digest(digest):
+                logging.error('Ignoring picture with bad digest %r' % digest)
+                return
+            self._previews_received(
+                {digest: utils.store_preview_data(base64.b64decode(data),
+                                                  digest)})
+        else:
+            path = self._received_path(payload.get("basename"))
+            if path is not None:
+                utils.base64_to_file(data, path)
+
+    def _received_path(self, basename):
+        ''' Where a picture a buddy sent by name is kept, or None if the
+        name is not a plain file name '''
+        if not basename or basename != os.path.basename(basename) or \
+           basename in ['.', '..']:
+            logging.error('Ignoring picture named %r' % basename)
+            return None
+        return os.path.join(self.tmp_path, basename)
+
+    def _previews_received(self, previews):
+        ''' Show the received previews ({digest: path}) in place of the
+        images they stand for, where we lack the image itself '''
+        if self._waiting_for_reflections:
+            return  # _store_images will find them in the store
+        for item in self.reflection_data:
+            for content in item.get('content', []):
+                path = previews.get(content.get('digest'))
+                if path is not None and 'image' in content and \
+                   not os.path.exists(content['image']):
+                    content['image'] = path
+        for path in previews.values():
+            self._reflect_window.picture_received(path)
+
+    def _share_received(self, collab, buddy, payload):
+        # Joiner needs to load reflection database.
+        if not self.initiating:
+            # Note that pictures should be received.
+            self.reflection_data = json.loads(payload.get("data"))
+            self._store_images(self.reflection_data, local=False)
+            self._rebuild_index()
+            self._snapshot_needed = True
+            self._sync_session = payload.get("session")
+            self._sync_vector = payload.get("vector", {})
+            self._sync_seq = max(self._sync_seq,
+                                 self._sync_vector.get(self._sync_author, 0))
+            self._reflect_window.load(self.reflection_data)
+            self._reflections_received()
+
+    def _reflections_received(self):
+        self._waiting_for_reflections = False
+        self.reset_cursor()
+        if self._joined_alert is not None:
+            self.remove_alert(self._joined_alert)
+            self._joined_alert = None
+
+    def _record_op(self, op):
+        ''' Note a synced change; returns False if it was seen before '''
+        author = op.get("author")
+        seq = op.get("seq")
+        if seq <= self._sync_vector.get(author, 0):
+            return False
+        self._sync_vector[author] = seq
+        if self.initiating:
+            self._sync_log.append(op)
+            if len(self._sync_log) > SYNC_LOG_SIZE:
+                old = self._sync_log.popleft()
+                self._sync_floor[old["author"]] = old["seq"]
+        return True
+
+    def _missing_ops(self, vector):
+        ''' The logged ops newer than vector, or None if some of them
+        have already been dropped from the log '''
+        for author, seq in self._sync_floor.items():
+            if vector.get(author, 0) < seq:
+                return None
+        return [op for op in self._sync_log
+                if op["seq"] > vector.get(op["author"], 0)]
+
+    def _picture_thumbnails(self, held):
+        ''' Yield (digest, basename, PNG data) for every picture reflection
+        whose digest is not in held '''
+        for item in self.reflection_data:
+            for content in item.get('content', []):
+                if 'image' not in content or content.get('digest') in held:
+                    continue
+                try:
+                    pixbuf = utils.get_pixbuf_from_file(
+                        content['image'], 120, 90, thumbnail=True)
+                except Exception as e:
+                    logging.error('Could not open %s: %s' %
+                                  (content['image'], e))
+                    continue
+                yield (content.get('digest'),
+                       os.path.basename(content['image']),
+                       utils.pixbuf_to_png(pixbuf))
+
+    def _send_picture_archive(self, buddy, held):
+        ''' Send the pictures a joiner lacks in one file transfer '''
+        records = [(digest, data) for digest, basename, data in
+                   self._picture_thumbnails(held) if digest is not None]
+        if len(records) == 0:
+            return
+        self.collab.send_file_memory(
+            buddy, utils.pack_records(records),
+            {"command": PICTURE_ARCHIVE_CMD, "count": len(records)})
+
+    def _incoming_file_cb(self, collab, ft, desc):
+        ''' Joiner receives the picture archive '''
+        if self.initiating or desc.get("command") != PICTURE_ARCHIVE_CMD:
+            return
+        path = os.path.join(self.tmp_path, 'pictures-%d' % int(time.time()))
+        while os.path.exists(path):
+            path += '_'
+        self._archives[ft] = [path, 0]
+        ft.connect('notify::transferred-bytes', self._archive_progress_cb)
+        ft.connect('notify::state', self._archive_state_cb)
+        ft.accept_to_file(path)
+
+    def _archive_progress_cb(self, ft, pspec):
+        self._read_archive(ft)
+
+    def _archive_state_cb(self, ft, pspec):
+        if ft.props.state == FT_STATE_COMPLETED:
+            # The transfer can complete before the splice into path has
+            # written the last bytes, so wait until the file is whole.
+            self._archive_written_cb(ft, ARCHIVE_POLL_LIMIT)
+        elif ft.props.state == FT_STATE_CANCELLED:
+            self._remove_archive(ft)
+
+    def _archive_written_cb(self, ft, polls):
+        if ft not in self._archives:
+            return False
+        path, offset = self._archives[ft]
+        if polls > 0 and (not os.path.exists(path) or
+                          os.path.getsize(path) < ft.file_size):
+            GObject.timeout_add(ARCHIVE_POLL_INTERVAL,
+                                self._archive_written_cb, ft, polls - 1)
+            return False
+        self._read_archive(ft)
+        self._remove_archive(ft)
+        return False
+
+    def _remove_archive(self, ft):
+        path, offset = self._archives.pop(ft)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _read_archive(self, ft):
+        ''' Write out the pictures received so far '''
+        if ft not in self._archives:
+            return
+        path, offset = self._archives[ft]
+        if not os.path.exists(path):
+            return
+        fd = open(path, 'rb')
+        fd.seek(offset)
+        data = fd.read()
+        fd.close()
+        records, size = utils.unpack_records(data)
+        self._archives[ft][1] = offset + size
+        previews = {}
+        for digest, picture in records:
+            if not utils.is_digest(digest):
+                logging.error('Ignoring picture with bad digest %r' % digest)
+                continue
+            previews[digest] = utils.store_preview_data(picture, digest)
+        self._previews_received(previews)
 
     def send_event(self, command, data):
         ''' Send event through the tube. '''
         if hasattr(self, 'collab') and self.collab is not None:
             data["command"] = command
-            self.collab.post(data)
+            if command in SYNCED_COMMANDS:
+                self._sync_seq += 1
+                data["author"] = self._sync_author
+                data["seq"] = self._sync_seq
+                self._record_op(data)
+            if command not in BATCHED_COMMANDS:
+                # Keep the order: anything queued goes first
+                self._flush_outbox()
+                self.collab.post(data)
+                return
+            if command in COALESCED_COMMANDS:
+                self._outbox = [op for op in self._outbox
+                                if op["command"] != command or
+                                op.get("obj_id") != data.get("obj_id")]
+            self._outbox.append(data)
+            if len(self._outbox) >= SEND_BATCH_SIZE:
+                self._flush_outbox()
+            elif self._outbox_id is None:
+                self._outbox_id = GObject.timeout_add(
+                    SEND_FLUSH_INTERVAL, self._outbox_timeout_cb)
+
+    def _outbox_timeout_cb(self):
+        self._outbox_id = None
+        self._flush_outbox()
+        return False
+
+    def _flush_outbox(self):
+        ''' Send the queued changes, several to a message '''
+        if self._outbox_id is not None:
+            GObject.source_remove(self._outbox_id)
+            self._outbox_id = None
+        if len(self._outbox) == 1:
+            self.collab.post(self._outbox[0])
+        elif len(self._outbox) > 1:
+            self.collab.post({"command": BATCH_CMD, "ops": self._outbox})
+        self._outbox = []
 
 
 class ChatTube(ExportedGObject):
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import json
+from collections import OrderedDict
+
+from gi.repository import GObject
+
+from sugar3.datastore import datastore
+
+import logging
+_logger = logging.getLogger('reflect-journal-queue')
+
+JOURNAL_FLUSH_DELAY = 1000  # ms without changes before they are written
+DSOBJECT_CACHE_SIZE = 20  # open Journal objects kept between writes
+
+
+class JournalQueue(object):
+    ''' Write-behind queue of Journal metadata changes. Changes to an
+    object are merged, and all pending objects are written once no change
+    has been queued for JOURNAL_FLUSH_DELAY ms, or when flush is called.
+    written_cb(obj_id, metadata) is called for each object written.
+    Cached objects are dropped when the datastore reports a change that
+    is not one of our writes, so they are never written back stale. '''
+
+    def __init__(self, written_cb=None):
+        self._written_cb = written_cb
+        self._pending = {}  # obj_id -> {'metadata': {}, 'comments': []}
+        self._flush_id = None
+        # obj_id -> [DSObject, parsed comments], least recently used first
+        self._dsobjects = OrderedDict()
+        # obj_id -> writes of ours the datastore has yet to report
+        self._own_writes = {}
+        datastore.updated.connect(self._datastore_updated_cb)
+        datastore.deleted.connect(self._datastore_deleted_cb)
+
+    def set_metadata(self, obj_id, key, value):
+        ''' Set a metadata property; a later value replaces this one '''
+        changes = self._get_changes(obj_id)
+        if changes is not None:
+            changes['metadata'][key] = value
+
+    def add_comment(self, obj_id, comment):
+        ''' Append a Journal comment ({from, message, icon-color}) '''
+        changes = self._get_changes(obj_id)
+        if changes is not None:
+            changes['comments'].append(comment)
+
+    def _get_changes(self, obj_id):
+        if obj_id is None or obj_id[0:4] == 'obj-':
+            return None  # Made in this activity; not in the Journal
+        if obj_id not in self._pending:
+            self._pending[obj_id] = {'metadata': {}, 'comments': []}
+        if self._flush_id is not None:
+            GObject.source_remove(self._flush_id)
+        self._flush_id = GObject.timeout_add(JOURNAL_FLUSH_DELAY,
+                                             self._flush_cb)
+        return self._pending[obj_id]
+
+    def forget(self, obj_id):
+        ''' Drop the cached object, e.g. when the Journal entry changed
+        outside of the activity '''
+        entry = self._dsobjects.pop(obj_id, None)
+        if entry is not None:
+            entry[0].destroy()
+
+    def _datastore_updated_cb(self, sender, object_id=None, **kwargs):
+        if not self._own_write_done(object_id):
+            self.forget(object_id)
+
+    def _datastore_deleted_cb(self, sender, object_id=None, **kwargs):
+        self.forget(object_id)
+
+    def _get_dsobject(self, obj_id):
+        ''' The open object and its parsed comments, from the cache if
+        possible '''
+        if obj_id in self._dsobjects:
+            entry = self._dsobjects.pop(obj_id)
+            self._dsobjects[obj_id] = entry
+            return entry
+        dsobj = datastore.get(obj_id)
+        comments = []
+        if 'comments' in dsobj.metadata:
+            try:
+                comments = json.loads(dsobj.metadata['comments'])
+            except ValueError:
+                _logger.error('Malformed comments in %s' % obj_id)
+        self._dsobjects[obj_id] = [dsobj, comments]
+        while len(self._dsobjects) > DSOBJECT_CACHE_SIZE:
+            old_id, old_entry = self._dsobjects.popitem(last=False)
+            old_entry[0].destroy()
+        return self._dsobjects[obj_id]
+
+    def _flush_cb(self):
+        self._flush_id = None
+        self.flush()
+        return False
+
+    def flush(self):
+        ''' Write every pending change now '''
+        if self._flush_id is not None:
+            GObject.source_remove(self._flush_id)
+            self._flush_id = None
+        pending = self._pending
+        self._pending = {}
+        for obj_id, changes in pending.items():
+            try:
+                dsobj, comments = self._get_dsobject(obj_id)
+            except Exception as e:
+                _logger.error('Could not open %s: %s' % (obj_id, e))
+                continue
+            for key, value in changes['metadata'].items():
+                dsobj.metadata[key] = value
+            if len(changes['comments']) > 0:
+                comments.extend(changes['comments'])
+                dsobj.metadata['comments'] = json.dumps(comments)
+            self._own_writes[obj_id] = self._own_writes.get(obj_id, 0) + 1
+            datastore.write(dsobj,
+                            update_mtime=False,
+                            reply_handler=self._datastore_write_cb,
+                            error_handler=lambda error, obj_id=obj_id:
+                            self._datastore_write_error_cb(obj_id, error))
+            if self._written_cb is not None:
+                self._written_cb(obj_id, dsobj.metadata)
+
+    def _datastore_write_cb(self):
+        _logger.debug('ds write cb')
+
+    def _datastore_write_error_cb(self, obj_id, error):
+        _logger.error('datastore_write_error_cb: %r' % error)
+        self._own_write_done(obj_id)  # No update will be reported
+
+    def _own_write_done(self, obj_id):
+        ''' Count off one of our writes to obj_id; False if there was
+        none '''
+        if obj_id not in self._own_writes:
+            return False
+        self._own_writes[obj_id] -= 1
+        if self._own_writes[obj_id] == 0:
+            del self._own_writes[obj_id]
+        return True
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import os
+
+try:
+    import sqlite3
+    Error = sqlite3.Error
+except ImportError:
+    sqlite3 = None
+    Error = Exception
+
+import logging
+_logger = logging.getLogger('reflect-db')
+
+HAVE_SQLITE = sqlite3 is not None
+MEMORY = ':memory:'  # path of a database that is not saved
+
+# The fields the sorts order by; position is the order of the
+# reflection in reflection_data.
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS reflections (
+    obj_id TEXT PRIMARY KEY,
+    position REAL,
+    title_key TEXT,
+    modification_time INTEGER,
+    stars INTEGER);
+CREATE INDEX IF NOT EXISTS reflections_position ON reflections (position);
+CREATE INDEX IF NOT EXISTS reflections_modification_time
+    ON reflections (modification_time);
+CREATE INDEX IF NOT EXISTS reflections_stars ON reflections (stars);
+CREATE INDEX IF NOT EXISTS reflections_title ON reflections (title_key);
+'''
+
+# ORDER BY for each sort; ties keep the order of the instance file, as
+# the stable sorts over reflection_data did.
+_ORDERS = {
+    'title': 'title_key, position',
+    'date': 'modification_time DESC, position',
+    'stars': 'stars DESC, position',
+}
+
+
+def _int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class ReflectionDB(object):
+    ''' An SQLite copy of the sort keys of the reflections, for sorts
+    that use indexes rather than scanning reflection_data. Reflections
+    without an obj_id are not stored. '''
+
+    def __init__(self, path):
+        if not HAVE_SQLITE:
+            raise Error('sqlite3 is not available')
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def import_records(self, records):
+        ''' Replace the contents of the database with records '''
+        with self._conn:
+            self._conn.execute('DELETE FROM reflections')
+            for position, record in enumerate(records):
+                self._insert(record, position)
+
+    def put(self, record, first=False):
+        ''' Add or replace a reflection; a new one goes at the end, or at
+        the start if first '''
+        if 'obj_id' not in record:
+            return
+        with self._conn:
+            row = self._conn.execute(
+                'SELECT position FROM reflections WHERE obj_id = ?',
+                (record['obj_id'],)).fetchone()
+            if row is not None:
+                position = row[0]
+            elif first:
+                position = self._conn.execute(
+                    'SELECT MIN(position) FROM reflections').fetchone()[0]
+                position = -1 if position is None else position - 1
+            else:
+                position = self._conn.execute(
+                    'SELECT MAX(position) FROM reflections').fetchone()[0]
+                position = 0 if position is None else position + 1
+            self._insert(record, position)
+
+    def delete(self, obj_id):
+        with self._conn:
+            self._conn.execute('DELETE FROM reflections WHERE obj_id = ?',
+                               (obj_id,))
+
+    def sorted_ids(self, order):
+        ''' obj_ids sorted by 'title', 'date' or 'stars' '''
+        return [row[0] for row in self._conn.execute(
+            'SELECT obj_id FROM reflections ORDER BY %s' % _ORDERS[order])]
+
+    def _insert(self, record, position):
+        obj_id = record.get('obj_id')
+        if obj_id is None:
+            return
+        self._conn.execute(
+            'INSERT OR REPLACE INTO reflections VALUES (?, ?, ?, ?, ?)',
+            (obj_id, position, record.get('title', '').lower(),
+             _int(record.get('modification_time')),
+             _int(record.get('stars'))))
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import os
+import json
+import shutil
+import struct
+
+from gi.repository import GObject
+
+import logging
+_logger = logging.getLogger('reflect-store')
+
+FILE_MAGIC = 'RFLX'
+INDEX_MAGIC = 'RIDX'
+FILE_VERSION = 1
+
+# How hard a save tries to reach the disk: FSYNC_ALWAYS syncs every write
+# before returning; FSYNC_TIMER syncs log appends in groups, at most
+# FSYNC_INTERVAL ms after they were written. Snapshots are synced before
+# they replace the old one in either mode.
+FSYNC_ALWAYS = 'always'
+FSYNC_TIMER = 'timer'
+FSYNC_INTERVAL = 5000
+
+_HEADER = struct.Struct('>4sH')
+_LENGTH = struct.Struct('>I')
+_OFFSET = struct.Struct('>Q')
+_TRAILER = struct.Struct('>QI4s')
+
+# The instance file is:
+#   header   FILE_MAGIC, version (>H)
+#   records  length (>I), JSON-encoded reflection; one per reflection
+#   index    offset (>Q) of each record
+#   trailer  index offset (>Q), record count (>I), INDEX_MAGIC
+# Files written before this format are a single JSON list, which
+# read_records still accepts.
+
+
+def write_records(fd, records):
+    ''' Write reflections to fd one record at a time '''
+    fd.write(_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+    offset = _HEADER.size
+    offsets = []
+    for record in records:
+        data = json.dumps(record)
+        offsets.append(offset)
+        fd.write(_LENGTH.pack(len(data)))
+        fd.write(data)
+        offset += _LENGTH.size + len(data)
+    for record_offset in offsets:
+        fd.write(_OFFSET.pack(record_offset))
+    fd.write(_TRAILER.pack(offset, len(offsets), INDEX_MAGIC))
+
+
+def read_index(fd):
+    ''' The record offsets from the index footer, or None if the file
+    has no valid footer (e.g. it was truncated) '''
+    fd.seek(0, 2)
+    size = fd.tell()
+    if size < _HEADER.size + _TRAILER.size:
+        return None
+    fd.seek(size - _TRAILER.size)
+    index_offset, count, magic = _TRAILER.unpack(fd.read(_TRAILER.size))
+    if magic != INDEX_MAGIC or \
+       index_offset + count * _OFFSET.size + _TRAILER.size != size:
+        return None
+    fd.seek(index_offset)
+    data = fd.read(count * _OFFSET.size)
+    return [_OFFSET.unpack_from(data, i * _OFFSET.size)[0]
+            for i in range(count)]
+
+
+def read_records(fd):
+    ''' Yield the reflections in fd as they are parsed '''
+    header = fd.read(_HEADER.size)
+    if len(header) < _HEADER.size or header[:4] != FILE_MAGIC:
+        # An instance saved as one JSON list
+        fd.seek(0)
+        for record in json.loads(fd.read()):
+            yield record
+        return
+
+    magic, version = _HEADER.unpack(header)
+    if version > FILE_VERSION:
+        raise ValueError('Unsupported file version %d' % version)
+
+    offsets = read_index(fd)
+    if offsets is None:
+        _logger.error('No index in file; reading records up to the end')
+        count = None
+    else:
+        count = len(offsets)
+    fd.seek(_HEADER.size)
+    n = 0
+    while count is None or n < count:
+        length = fd.read(_LENGTH.size)
+        if len(length) < _LENGTH.size:
+            break
+        size = _LENGTH.unpack(length)[0]
+        data = fd.read(size)
+        if len(data) < size:
+            _logger.error('Truncated record %d' % n)
+            break
+        try:
+            yield json.loads(data)
+        except ValueError:
+            if count is None:
+                break  # Past the last record of a damaged file
+            raise
+        n += 1
+
+
+def fsync_directory(path):
+    ''' Make a rename in directory path durable '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        _logger.error('Could not open %s: %s' % (path, e))
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass  # Not supported on every file system
+    finally:
+        os.close(fd)
+
+
+def save_records(path, records, sync_directory=True):
+    ''' Replace the file at path with records, so that a crash leaves
+    either the old file or the new one, never a partly written one '''
+    tmp_path = path + '.tmp'
+    fd = open(tmp_path, 'wb')
+    try:
+        write_records(fd, records)
+        fd.flush()
+        os.fsync(fd.fileno())
+    finally:
+        fd.close()
+    os.rename(tmp_path, path)
+    if sync_directory:
+        fsync_directory(os.path.dirname(os.path.abspath(path)))
+
+
+def append_records(fd, records):
+    ''' Append length-prefixed JSON records (no index) to fd '''
+    for record in records:
+        data = json.dumps(record)
+        fd.write(_LENGTH.pack(len(data)))
+        fd.write(data)
+
+
+def read_appended(fd):
+    ''' Yield the records written by append_records, stopping at a
+    partly written last record '''
+    while True:
+        length = fd.read(_LENGTH.size)
+        if len(length) < _LENGTH.size:
+            return
+        size = _LENGTH.unpack(length)[0]
+        data = fd.read(size)
+        if len(data) < size:
+            _logger.error('Ignoring partly written log record')
+            return
+        try:
+            yield json.loads(data)
+        except ValueError:
+            _logger.error('Ignoring damaged log record')
+            return
+
+
+class ReflectStore(object):
+    ''' A snapshot of an instance and an append-only log of the records
+    changed since, kept in the activity's data directory. The log starts
+    with the generation of the snapshot it applies to; a new snapshot
+    gets a new generation and an empty log. '''
+
+    def __init__(self, path, name, fsync_mode=FSYNC_ALWAYS):
+        self._path = path
+        self._snapshot_path = os.path.join(path, name + '.snapshot')
+        self._log_path = os.path.join(path, name + '.log')
+        self._fsync_mode = fsync_mode
+        self._unsynced = False  # log or directory changed since an fsync
+        self._sync_id = None
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def has_snapshot(self):
+        return os.path.exists(self._snapshot_path)
+
+    def log_size(self):
+        if not os.path.exists(self._log_path):
+            return 0
+        return os.path.getsize(self._log_path)
+
+    def write_snapshot(self, records, generation):
+        ''' Save every record, and start an empty log for generation '''
+        save_records(self._snapshot_path, records, sync_directory=False)
+        tmp_path = self._log_path + '.tmp'
+        fd = open(tmp_path, 'wb')
+        try:
+            append_records(fd, [{'generation': generation}])
+            fd.flush()
+            os.fsync(fd.fileno())
+        finally:
+            fd.close()
+        os.rename(tmp_path, self._log_path)
+        self._unsynced = False
+        self._sync_directory()
+
+    def copy_snapshot(self, file_path):
+        ''' Put the snapshot at file_path, linking it where possible '''
+        try:
+            os.link(self._snapshot_path, file_path)
+        except OSError:
+            shutil.copy(self._snapshot_path, file_path)
+
+    def append(self, entries):
+        ''' Log changes: {'put': record, 'index': n} or {'delete': obj_id} '''
+        fd = open(self._log_path, 'ab')
+        try:
+            append_records(fd, entries)
+            fd.flush()
+            if self._fsync_mode == FSYNC_ALWAYS:
+                os.fsync(fd.fileno())
+        finally:
+            fd.close()
+        if self._fsync_mode != FSYNC_ALWAYS:
+            # A torn last record is dropped by replay, so the log may
+            # reach the disk later
+            self._schedule_sync()
+
+    def _schedule_sync(self):
+        self._unsynced = True
+        if self._sync_id is None:
+            self._sync_id = GObject.timeout_add(FSYNC_INTERVAL,
+                                                self._sync_cb)
+
+    def _sync_cb(self):
+        self._sync_id = None
+        self.sync()
+        return False
+
+    def sync(self):
+        ''' fsync the log and its directory now if they have unsynced
+        changes '''
+        if self._sync_id is not None:
+            GObject.source_remove(self._sync_id)
+            self._sync_id = None
+        if not self._unsynced:
+            return
+        self._unsynced = False
+        try:
+            fd = open(self._log_path, 'ab')
+            try:
+                os.fsync(fd.fileno())
+            finally:
+                fd.close()
+        except (IOError, OSError) as e:
+            _logger.error('Could not sync %s: %s' % (self._log_path, e))
+        fsync_directory(self._path)
+
+    def _sync_directory(self):
+        if self._fsync_mode == FSYNC_ALWAYS:
+            fsync_directory(self._path)
+        else:
+            self._schedule_sync()
+
+    def replay(self, records, generation):
+        ''' Apply the log to records read from the snapshot of generation;
+        returns False, leaving records alone, if the log belongs to a
+        different snapshot '''
+        if generation is None or not os.path.exists(self._log_path):
+            return False
+        fd = open(self._log_path, 'rb')
+        try:
+            entries = read_appended(fd)
+            header = next(entries, None)
+            if header is None or header.get('generation') != generation:
+                return False
+            index = self._index(records)
+            for entry in entries:
+                if 'delete' in entry:
+                    i = index.get(entry['delete'])
+                    if i is not None:
+                        del records[i]
+                        index = self._index(records)
+                elif 'put' in entry:
+                    record = entry['put']
+                    i = index.get(record.get('obj_id'))
+                    if i is not None:
+                        records[i] = record
+                    else:
+                        # New records are placed as they were when logged
+                        records.insert(min(entry.get('index', 0),
+                                           len(records)), record)
+                        index = self._index(records)
+        finally:
+            fd.close()
+        return True
+
+    def _index(self, records):
+        index = {}
+        for i, record in enumerate(records):
+            if 'obj_id' in record:
+                index[record['obj_id']] = i
+        return index
@@ -20,12 +20,10 @@ from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GObject
 from gi.repository import GConf
-from gi.repository import GdkPixbuf
 from gi.repository import Pango
 
 from sugar3.graphics import style
 from sugar3.graphics.icon import CanvasIcon, EventIcon
-from sugar3.datastore import datastore
 from sugar3 import profile
 from sugar3 import util
 
@@ -43,6 +41,10 @@ PICTURE_WIDTH = 6 * style.GRID_CELL_SIZE
 PICTURE_HEIGHT = int(4.5 * style.GRID_CELL_SIZE)
 REFLECTION_WIDTH = 8 * style.GRID_CELL_SIZE
 
+VIRTUAL_LIST_THRESHOLD = 30  # longer lists only build the visible cards
+OVERSCAN = int(Gdk.Screen.height() / 2)  # build cards this close to view
+RELEASE_DISTANCE = 3 * Gdk.Screen.height()  # free cards this far away
+
 NEW_REFLECTION_CMD = 'N'
 TITLE_CMD = 'T'
 STAR_CMD = '*'
@@ -60,6 +62,11 @@ class ReflectWindow(Gtk.Alignment):
         Gtk.Alignment.__init__(self)
         self._activity = activity
         self._reflections = []
+        self._reflection_index = {}
+        self._spacer = None
+        self._row = 0
+        self._virtual = False
+        self._viewport_id = None
 
         self.set_size_request(Gdk.Screen.width() - style.GRID_CELL_SIZE, -1)
 
@@ -73,6 +80,10 @@ class ReflectWindow(Gtk.Alignment):
 
         self._activity.load_graphics_area(self)
 
+        adjustment = self._activity.get_vadjustment()
+        adjustment.connect('value-changed', self._queue_viewport_update)
+        adjustment.connect('changed', self._queue_viewport_update)
+
         if self._activity.initiating:
             entry = Gtk.Entry()
             entry.props.placeholder_text = _('Add a reflection')
@@ -81,28 +92,63 @@ class ReflectWindow(Gtk.Alignment):
             entry.show()
 
     def reload(self, reflection_data):
+        ''' Reorder, show or hide the slots we already have (keyed by
+        obj_id); only reflections we have not seen get new widgets. '''
         logging.debug('reloading reflection data')
         for reflection in self._reflections:
-            reflection.graphics.hide()
-        self.load(reflection_data)
+            self._reflections_grid.remove(reflection.slot)
+        if self._spacer is not None:
+            self._reflections_grid.remove(self._spacer)
+        old_index = self._reflection_index
+        self._reflections = []
+        self._reflection_index = {}
+        if len(reflection_data) > VIRTUAL_LIST_THRESHOLD:
+            self._virtual = True
 
-    def load(self, reflection_data):
+        row = self._first_row()
+        for item in reflection_data:
+            if item.get('deleted'):
+                continue
+            reflection = old_index.pop(item.get('obj_id'), None)
+            if reflection is None:
+                reflection = Reflection(self._activity, item)
+            elif reflection.data is not item:
+                # Same reflection, replacement record: rebuild its card
+                reflection.data = item
+                if reflection.graphics is not None:
+                    self._release(reflection)
+                    self._materialize(reflection)
+            self._attach_reflection(reflection, row)
+            row += 1
+
+        # Whatever is left over has been deleted
+        for reflection in old_index.values():
+            reflection.slot.destroy()
+
+        if self._spacer is not None:
+            self._reflections_grid.attach(self._spacer, 0, row, 1, 1)
+        self._row = row
+        self._queue_viewport_update()
+
+    def _first_row(self):
         if self._activity.initiating:
-            row = 1  # 0 is the entry for new reflections
-        else:
-            row = 0
+            return 1  # 0 is the entry for new reflections
+        return 0
+
+    def load(self, reflection_data):
+        if self._spacer is not None:
+            self.reload(reflection_data)
+            return
+
+        row = self._first_row()
+        self._virtual = len(reflection_data) > VIRTUAL_LIST_THRESHOLD
 
         for item in reflection_data:
             if item.get('deleted'):
                 reflection_data.remove(item)
                 continue
 
-            reflection = Reflection(self._activity, item)
-            reflection.set_obj_id()
-            self._reflections_grid.attach(
-                reflection.get_graphics(), 0, row, 1, 1)
-            reflection.refresh()
-            self._reflections.append(reflection)
+            self._attach_reflection(Reflection(self._activity, item), row)
             row += 1
 
         # Add an empty box at the end to expand the scrolled window
@@ -115,71 +161,168 @@ class ReflectWindow(Gtk.Alignment):
         box.show()
         self._reflections_grid.attach(eb, 0, row, 1, 1)
         eb.show()
+        self._spacer = eb
+        self._row = row
+        self._queue_viewport_update()
+
+    def add_items(self, reflection_data):
+        ''' Append reflections below those already loaded '''
+        if len(self._reflections) + len(reflection_data) > \
+           VIRTUAL_LIST_THRESHOLD:
+            self._virtual = True
+        if self._spacer is not None:
+            self._reflections_grid.remove(self._spacer)
+        for item in reflection_data:
+            self._attach_reflection(
+                Reflection(self._activity, item), self._row)
+            self._row += 1
+        if self._spacer is not None:
+            self._reflections_grid.attach(self._spacer, 0, self._row, 1, 1)
+        self._queue_viewport_update()
+
+    def _insert_reflection(self, reflection):
+        ''' Add a reflection at the top of the list '''
+        row = self._first_row()
+        self._reflections_grid.insert_row(row)
+        self._row += 1
+        self._attach_reflection(reflection, row, materialize=True)
 
-    def update_title(self, obj_id, text):
-        for item in self._reflections:
-            if item.obj_id == obj_id:
-                item.graphics.update_title(text)
-                break
+    def _attach_reflection(self, reflection, row, materialize=False):
+        ''' Each reflection sits in a slot that holds either its
+        ReflectionGrid or, in a virtualized list, just its height. '''
+        if reflection.slot is None:
+            reflection.set_obj_id()
+            reflection.slot = Gtk.Box()
+            if materialize or not self._virtual:
+                self._materialize(reflection)
+            else:
+                reflection.slot.set_size_request(
+                    REFLECTION_WIDTH, reflection.estimate_height())
+        self._reflections_grid.attach(reflection.slot, 0, row, 1, 1)
+        reflection.refresh()
+        self._reflections.append(reflection)
+        self._reflection_index[reflection.obj_id] = reflection
 
-    def update_stars(self, obj_id, stars):
-        for item in self._reflections:
-            if item.obj_id == obj_id:
-                item.graphics.update_stars(stars)
-                break
+    def _materialize(self, reflection):
+        if reflection.graphics is not None:
+            return
+        reflection.slot.set_size_request(-1, -1)
+        reflection.slot.add(reflection.get_graphics())
+        reflection.refresh()
+
+    def _release(self, reflection):
+        height = reflection.graphics.get_allocated_height()
+        reflection.slot.remove(reflection.graphics)
+        reflection.graphics.destroy()
+        reflection.graphics = None
+        reflection.slot.set_size_request(REFLECTION_WIDTH, height)
+
+    def _queue_viewport_update(self, adjustment=None):
+        if self._virtual and self._viewport_id is None:
+            self._viewport_id = GObject.idle_add(self._update_viewport)
+
+    def _update_viewport(self):
+        ''' Build the cards near the viewport; free those far from it '''
+        self._viewport_id = None
+        adjustment = self._activity.get_vadjustment()
+        top = adjustment.get_value()
+        bottom = top + adjustment.get_page_size()
+        for reflection in self._reflections:
+            if not reflection.slot.get_visible():
+                continue
+            allocation = reflection.slot.get_allocation()
+            if allocation.height <= 1:
+                continue  # Not laid out yet
+            y0 = allocation.y
+            y1 = allocation.y + allocation.height
+            if y1 >= top - OVERSCAN and y0 <= bottom + OVERSCAN:
+                self._materialize(reflection)
+            elif reflection.graphics is not None and \
+                 (y1 < top - RELEASE_DISTANCE or
+                  y0 > bottom + RELEASE_DISTANCE) and \
+                 reflection.graphics.can_release():
+                self._release(reflection)
+        return False
+
+    def update_title(self, obj_id, text):
+        item = self._reflection_index.get(obj_id)
+        if item is None:
+            return
+        if item.graphics is not None:
+            item.graphics.update_title(text)
+        else:
+            item.set_title(text)
+
+    def update_stars(self, obj_id, stars, count=None):
+        item = self._reflection_index.get(obj_id)
+        if item is None:
+            return
+        if item.graphics is not None:
+            item.graphics.update_stars(stars, count)
+        else:
+            item.update_stars(stars, count)
 
     def update_tags(self, obj_id, data):
-        for item in self._reflections:
-            if item.obj_id == obj_id:
-                item.graphics.add_tags(data)
-                break
+        item = self._reflection_index.get(obj_id)
+        if item is None:
+            return
+        if item.graphics is not None:
+            item.graphics.add_tags(data)
+        else:
+            item.data['tags'] = json.loads(data)
+            self._activity.retag_item(item.data)
 
     def insert_comment(self, obj_id, comment):
-        for item in self._reflections:
-            if item.obj_id == obj_id:
-                item.graphics.add_new_comment(comment)
-                item.graphics.notify_button.show()
-                # Update journal entry
-                if obj_id[0:4] == 'obj-':
-                    break
-                try:
-                    dsobj = datastore.get(obj_id)
-                except Exception as e:
-                    logging.error('Could not open %s: %e' % (obj_id, e))
-                    break
-                if 'comments' in dsobj.metadata:
-                    data = json.loads(dsobj.metadata['comments'])
-                else:
-                    data = []
-                data.append({'from': comment['nick'],
-                             'message': comment['comment'],
-                             'icon-color': '%s,%s' % (
-                                 comment['color'], comment['color'])
-                           })
-                dsobj.metadata['comments'] = json.dumps(data)
-                datastore.write(dsobj,
-                                update_mtime=False,
-                                reply_handler=self.datastore_write_cb,
-                                error_handler=self.datastore_write_error_cb)
-                break
+        item = self._reflection_index.get(obj_id)
+        if item is None:
+            return
+        if item.graphics is not None:
+            item.graphics.add_new_comment(comment)
+            item.graphics.notify_button.show()
+        # Update journal entry
+        self._activity.journal_queue.add_comment(
+            obj_id, {'from': comment['nick'],
+                     'message': comment['comment'],
+                     'icon-color': '%s,%s' % (
+                         comment['color'], comment['color'])})
 
     def insert_activity(self, obj_id, bundle_id):
-        for item in self._reflections:
-            if item.obj_id == obj_id:
-                item.graphics.add_activity(bundle_id)
-                break
+        item = self._reflection_index.get(obj_id)
+        if item is None:
+            return
+        if item.graphics is not None:
+            item.graphics.add_activity(bundle_id)
+        else:
+            item.add_activity(utils.bundle_id_to_icon(bundle_id))
+            item.set_modification_time()
 
     def insert_reflection(self, obj_id, reflection):
-        for item in self._reflections:
-            if item.obj_id == obj_id:
-                item.graphics.add_new_reflection(reflection)
-                break
+        item = self._reflection_index.get(obj_id)
+        if item is not None and item.graphics is not None:
+            item.graphics.add_new_reflection(reflection)
+
+    def insert_picture(self, obj_id, path, digest=None):
+        item = self._reflection_index.get(obj_id)
+        if item is None:
+            return
+        if item.graphics is not None:
+            item.graphics.add_new_picture(path, digest)
+        else:
+            if not 'content' in item.data:
+                item.data['content'] = []
+            item.add_image(path, digest)
 
-    def insert_picture(self, obj_id, path):
-        for item in self._reflections:
-            if item.obj_id == obj_id:
-                item.graphics.add_new_picture(path)
-                break
+    def picture_received(self, path):
+        ''' Rebuild the cards showing an image that arrived late '''
+        for reflection in self._reflections:
+            if reflection.graphics is None or \
+               not reflection.graphics.can_release():
+                continue
+            for item in reflection.data.get('content', []):
+                if item.get('image') == path:
+                    self._release(reflection)
+                    self._materialize(reflection)
+                    break
 
     def _entry_activate_cb(self, entry):
         text = entry.props.text
@@ -192,11 +335,9 @@ class ReflectWindow(Gtk.Alignment):
         reflection.add_activity(
             utils.bundle_id_to_icon('org.sugarlabs.Reflect'))
         reflection.set_stars(0)
-        self._reflections_grid.insert_row(1)
-        self._reflections_grid.attach(
-            reflection.get_graphics(), 0, 1, 1, 1)
-        reflection.refresh()
-        self._reflections.append(reflection)
+        reflection.data['nick'] = profile.get_nick_name()
+        self._activity.index_item(reflection.data)
+        self._insert_reflection(reflection)
         entry.set_text('')
         if self._activity.sharing:
             data = json.dumps(self._activity.reflection_data[0])
@@ -207,11 +348,17 @@ class ReflectWindow(Gtk.Alignment):
         self._activity.reflection_data.insert(0, reflection_data)
         reflection = Reflection(self._activity,
                                 self._activity.reflection_data[0])
-        self._reflections_grid.insert_row(0)
-        self._reflections_grid.attach(
-            reflection.get_graphics(), 0, 1, 1, 1)
-        reflection.refresh()
-        self._reflections.append(reflection)
+        self._activity.index_item(reflection.data)
+        self._insert_reflection(reflection)
+        return reflection.data
+
+    def refresh_items(self, obj_ids):
+        ''' Show or hide the given reflections to match their data '''
+        for obj_id in obj_ids:
+            reflection = self._reflection_index.get(obj_id)
+            if reflection is not None and reflection.slot is not None:
+                reflection.refresh()
+        self._queue_viewport_update()
 
     def keypress_cb(self, widget, event):
         self.keyname = Gdk.keyval_name(event.keyval)
@@ -225,6 +372,7 @@ class ReflectionGrid(Gtk.EventBox):
         self._reflection = parent
         self._collapse = True
         self._collapse_id = None
+        self._expanded = False
 
         self.modify_bg(
             Gtk.StateType.NORMAL, style.COLOR_WHITE.get_gdk_color())
@@ -306,6 +454,79 @@ class ReflectionGrid(Gtk.EventBox):
         self._time_align.show()
         row += 1
 
+        # Tags, stars, the remaining content and the comments are only
+        # visible once the card is expanded; reserve their rows and build
+        # them on the first expand (see _build_details).
+        self._details_built = False
+        self._tag_row = row
+        row += 1
+
+        self._activities_align = Gtk.Alignment.new(
+            xalign=0, yalign=0.5, xscale=0, yscale=0)
+        self._make_activities_grid()
+        self._grid.attach(self._activities_align, 1, row, 5, 1)
+        self._activities_align.show()
+
+        if self._reflection.activity.initiating:
+            self._new_activity = EventIcon(icon_name='add-item',
+                                           pixel_size=BUTTON_SIZE)
+            self._new_activity.set_tooltip(_('Add new activity'))
+            self._new_activity.connect('button-press-event',
+                                       self._activity_button_cb)
+            self._grid.attach(self._new_activity, 6, row, 1, 1)
+            self._new_activity.show()
+        row += 1
+
+        self._stars_row = row
+        row += 1
+
+        self._content_aligns = []
+        self._deferred_content = []
+        first_text = True
+        first_image = True
+        self._content_we_always_show = []
+        if 'content' in self._reflection.data:
+            for i, item in enumerate(self._reflection.data['content']):
+                if 'text' in item and first_text:
+                    align = self._make_text_align(item['text'], i)
+                    first_text = False
+                elif 'image' in item and first_image:
+                    align = self._make_image_align(item['image'])
+                    if align is None:
+                        continue
+                    first_image = False
+                else:
+                    self._deferred_content.append((i, item, row))
+                    row += 1
+                    continue
+                self._grid.attach(align, 1, row, 5, 1)
+                self._content_aligns.append(align)
+                self._content_we_always_show.append(align)
+                row += 1
+
+        self._row = row
+        if self._reflection.activity.initiating:
+            self._new_entry = Gtk.Entry()
+            self._new_entry.props.placeholder_text = _('Write a reflection')
+            self._new_entry.connect('activate', self._entry_activate_cb)
+            self._grid.attach(self._new_entry, 1, row, 5, 1)
+            self._content_we_always_show.append(self._new_entry)
+            self._new_image = EventIcon(icon_name='add-picture',
+                                        pixel_size=BUTTON_SIZE)
+            self._new_image.set_tooltip(_('Add new image'))
+            self._new_image.connect('button-press-event', self._image_button_cb)
+            self._grid.attach(self._new_image, 6, row, 1, 1)
+            self._content_we_always_show.append(self._new_image)
+
+        for align in self._content_we_always_show:
+            align.show()
+
+        self._comment_aligns = []
+
+    def _build_details(self):
+        ''' Build the parts of the card only shown when expanded '''
+        self._details_built = True
+
         label = ''
         if 'tags' in self._reflection.data:
             for tag in self._reflection.data['tags']:
@@ -328,31 +549,14 @@ class ReflectionGrid(Gtk.EventBox):
             self._tag_view.set_editable(False)
         self._tag_align.add(self._tag_view)
         self._tag_view.show()
-        self._grid.attach(self._tag_align, 1, row, 5, 1)
+        self._grid.attach(self._tag_align, 1, self._tag_row, 5, 1)
 
         if self._reflection.activity.initiating:
             self._new_tag = EventIcon(icon_name='ok',
                                       pixel_size=BUTTON_SIZE)
             self._new_tag.connect('button-press-event',
                                   self._tag_button_cb)
-            self._grid.attach(self._new_tag, 6, row, 1, 1)
-        row += 1
-
-        self._activities_align = Gtk.Alignment.new(
-            xalign=0, yalign=0.5, xscale=0, yscale=0)
-        self._make_activities_grid()
-        self._grid.attach(self._activities_align, 1, row, 5, 1)
-        self._activities_align.show()
-
-        if self._reflection.activity.initiating:
-            self._new_activity = EventIcon(icon_name='add-item',
-                                           pixel_size=BUTTON_SIZE)
-            self._new_activity.set_tooltip(_('Add new activity'))
-            self._new_activity.connect('button-press-event',
-                                       self._activity_button_cb)
-            self._grid.attach(self._new_activity, 6, row, 1, 1)
-            self._new_activity.show()
-        row += 1
+            self._grid.attach(self._new_tag, 6, self._tag_row, 1, 1)
 
         self._stars_align = Gtk.Alignment.new(
             xalign=0, yalign=0.5, xscale=0, yscale=0)
@@ -376,90 +580,24 @@ class ReflectionGrid(Gtk.EventBox):
             self._star_icons[-1].show()
         self._stars_align.add(grid)
         grid.show()
-        self._grid.attach(self._stars_align, 1, row, 5, 1)
-        row += 1
+        self._grid.attach(self._stars_align, 1, self._stars_row, 5, 1)
 
-        self._content_aligns = []
-        first_text = True
-        first_image = True
-        self._content_we_always_show = []
-        if 'content' in self._reflection.data:
-            for i, item in enumerate(self._reflection.data['content']):
-                # Add edit and delete buttons
-                align = Gtk.Alignment.new(
-                    xalign=0, yalign=0.5, xscale=0, yscale=0)
-                obj = None
-                if 'text' in item:
-                    obj = Gtk.TextView()
-                    obj.set_size_request(ENTRY_WIDTH, -1)
-                    obj.set_wrap_mode(Gtk.WrapMode.WORD)
-
-                    obj.get_buffer().set_text(item['text'])
-                    if self._reflection.activity.initiating:
-                        obj.connect('focus-in-event', self._text_focus_in_cb)
-                        obj.connect(
-                            'focus-out-event', self._text_focus_out_cb, i)
-                    else:
-                        obj.set_editable(False)
-                    if first_text:
-                        self._content_we_always_show.append(align)
-                        first_text = False
-                elif 'image' in item:
-                    try:
-                        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                            item['image'], PICTURE_WIDTH, PICTURE_HEIGHT)
-                        obj = Gtk.Image.new_from_pixbuf(pixbuf)
-                        if first_image:
-                            self._content_we_always_show.append(align)
-                            first_image = False
-                    except:
-                        logging.error('could not open %s' % item['image'])
-                if obj is not None:
-                    align.add(obj)
-                    obj.show()
-                    self._grid.attach(align, 1, row, 5, 1)
-                    self._content_aligns.append(align)
-                    row += 1
-
-        self._row = row
-        if self._reflection.activity.initiating:
-            self._new_entry = Gtk.Entry()
-            self._new_entry.props.placeholder_text = _('Write a reflection')
-            self._new_entry.connect('activate', self._entry_activate_cb)
-            self._grid.attach(self._new_entry, 1, row, 5, 1)
-            self._content_we_always_show.append(self._new_entry)
-            self._new_image = EventIcon(icon_name='add-picture',
-                                        pixel_size=BUTTON_SIZE)
-            self._new_image.set_tooltip(_('Add new image'))
-            self._new_image.connect('button-press-event', self._image_button_cb)
-            self._grid.attach(self._new_image, 6, row, 1, 1)
-            self._content_we_always_show.append(self._new_image)
-
-        for align in self._content_we_always_show:
-            align.show()
-        row += 1
+        for i, item, row in self._deferred_content:
+            if 'text' in item:
+                align = self._make_text_align(item['text'], i)
+            elif 'image' in item:
+                align = self._make_image_align(item['image'])
+            else:
+                align = None
+            if align is not None:
+                self._grid.attach(align, 1, row, 5, 1)
+                self._content_aligns.append(align)
+        self._deferred_content = []
 
-        self._comment_row = row
-        self._comment_aligns = []
+        self._comment_row = self._row + 1
         if 'comments' in self._reflection.data:
             for comment in self._reflection.data['comments']:
-                obj = Gtk.TextView()
-                obj.set_editable(False)
-                obj.set_size_request(ENTRY_WIDTH, -1)
-                obj.set_wrap_mode(Gtk.WrapMode.WORD)
-                nick_tag = obj.get_buffer().create_tag(
-                    'nick', foreground=comment['color'],
-                    weight=Pango.Weight.BOLD)
-                iter_text = obj.get_buffer().get_iter_at_offset(0)
-                obj.get_buffer().insert_with_tags(
-                    iter_text, comment['nick'] + ': ', nick_tag)
-                iter_text = obj.get_buffer().get_end_iter()
-                obj.get_buffer().insert(iter_text, comment['comment'])
-
-                align = Gtk.Alignment.new(
-                    xalign=0, yalign=0.5, xscale=0, yscale=0)
-                align.add(obj)
-                obj.show()
+                align = self._make_comment_align(comment)
                 self._grid.attach(align, 1, self._comment_row, 5, 1)
                 self._comment_aligns.append(align)
                 self._comment_row += 1
@@ -468,34 +606,72 @@ class ReflectionGrid(Gtk.EventBox):
         self._new_comment.connect('activate', self._comment_activate_cb)
         self._grid.attach(self._new_comment, 1, self._comment_row, 5, 1)
 
+    def _make_text_align(self, text, i):
+        obj = Gtk.TextView()
+        obj.set_size_request(ENTRY_WIDTH, -1)
+        obj.set_wrap_mode(Gtk.WrapMode.WORD)
+
+        obj.get_buffer().set_text(text)
+        if self._reflection.activity.initiating:
+            obj.connect('focus-in-event', self._text_focus_in_cb)
+            obj.connect('focus-out-event', self._text_focus_out_cb, i)
+        else:
+            obj.set_editable(False)
+        align = Gtk.Alignment.new(xalign=0, yalign=0.5, xscale=0, yscale=0)
+        align.add(obj)
+        obj.show()
+        return align
+
+    def _make_image_align(self, path):
+        try:
+            pixbuf = utils.get_pixbuf_from_file(
+                path, PICTURE_WIDTH, PICTURE_HEIGHT, thumbnail=True)
+        except:
+            logging.error('could not open %s' % path)
+            return None
+        obj = Gtk.Image.new_from_pixbuf(pixbuf)
+        align = Gtk.Alignment.new(xalign=0, yalign=0.5, xscale=0, yscale=0)
+        align.add(obj)
+        obj.show()
+        return align
+
+    def _make_comment_align(self, comment):
+        obj = Gtk.TextView()
+        obj.set_editable(False)
+        obj.set_size_request(ENTRY_WIDTH, -1)
+        obj.set_wrap_mode(Gtk.WrapMode.WORD)
+        nick_tag = obj.get_buffer().create_tag(
+            'nick', foreground=comment['color'],
+            weight=Pango.Weight.BOLD)
+        iter_text = obj.get_buffer().get_iter_at_offset(0)
+        obj.get_buffer().insert_with_tags(
+            iter_text, comment['nick'] + ': ', nick_tag)
+        iter_text = obj.get_buffer().get_end_iter()
+        obj.get_buffer().insert(iter_text, comment['comment'])
+
+        align = Gtk.Alignment.new(xalign=0, yalign=0.5, xscale=0, yscale=0)
+        align.add(obj)
+        obj.show()
+        return align
+
     def _star_button_cb(self, button, event, n):
         self.update_stars(n)
         if self._reflection.activity.sharing:
+            # count lets a later STAR_CMD supersede this one
             self._reflection.activity.send_event(STAR_CMD,
-                {"obj_id": self._reflection.data["obj_id"], "stars": n})
+                {"obj_id": self._reflection.data["obj_id"], "stars": n,
+                 "count": self._reflection.data['stars']})
 
-    def update_stars(self, n):
-        if 'stars' in self._reflection.data:
-            oldn = self._reflection.data['stars']
-        else:
-            oldn = 0
-        if n < oldn:  # Erase stars, including one that was clicked
-            for i in range(NUMBER_OF_STARS):
-                if i < n:
-                    icon_name = 'star-filled'
-                else:
-                    icon_name = 'star-empty'
-                self._star_icons[i].set_icon_name(icon_name)
-            self._reflection.data['stars'] = n
-        else:  # Add stars, including one that was clicked
-            for i in range(NUMBER_OF_STARS):
-                if i <= n:
-                    icon_name = 'star-filled'
-                else:
-                    icon_name = 'star-empty'
-                self._star_icons[i].set_icon_name(icon_name)
-            self._reflection.data['stars'] = n + 1
-        self._reflection.set_modification_time()
+    def update_stars(self, n, count=None):
+        self._reflection.update_stars(n, count)
+        if not self._details_built:
+            return
+        for i in range(NUMBER_OF_STARS):
+            if i < self._reflection.data['stars']:
+                icon_name = 'star-filled'
+            else:
+                icon_name = 'star-empty'
+            self._star_icons[i].set_icon_name(icon_name)
 
     def _text_focus_in_cb(self, widget, event):
         rgba = Gdk.RGBA()
@@ -507,6 +683,8 @@ class ReflectionGrid(Gtk.EventBox):
         bounds = widget.get_buffer().get_bounds()
         text = widget.get_buffer().get_text(bounds[0], bounds[1], True)
         self._reflection.data['content'][entry]['text'] = text
+        self._reflection.activity.mark_dirty(self._reflection.data['obj_id'])
+        self._reflection.activity.reindex_text(self._reflection.data)
         rgba = Gdk.RGBA()
         rgba.red, rgba.green, rgba.blue = 1., 1., 1.
         rgba.alpha = 1.
@@ -553,38 +731,37 @@ class ReflectionGrid(Gtk.EventBox):
                 self._reflection.data['tags'].append('#' + tag)
                 label += '#' + tag
         text_buffer.set_text(label.replace('\12', ''))
+        self._reflection.activity.retag_item(self._reflection.data)
         if self._reflection.activity.sharing:
             data = json.dumps(self._reflection.data['tags'])
             self._reflection.activity.send_event(TAG_CMD,
-                {"obj_id": self._refelection.data["ob_id"],
-                 "reflection": data})
+                {"obj_id": self._reflection.data["obj_id"],
+                 "data": data})
         self._reflection.set_modification_time()
 
         # Update journal entry
-        dsobj = datastore.get(self._reflection.data['obj_id'])
-        logging.error('setting tags to %s' % label)
-        dsobj.metadata['tags'] = label
-        datastore.write(dsobj,
-                        update_mtime=False,
-                        reply_handler=self.datastore_write_cb,
-                        error_handler=self.datastore_write_error_cb)
+        self._reflection.activity.journal_queue.set_metadata(
+            self._reflection.data['obj_id'], 'tags', label)
 
     def add_tags(self, data):
         ''' process encoded tag data from share '''
         tags = json.loads(data)
         self._reflection.data['tags'] = tags[:]
+        self._reflection.activity.retag_item(self._reflection.data)
         label = ''
         for tag in tags:
             if len(label) > 0:
                 label += ', '
             label += tag
-        self._tag_view.get_buffer().set_text(label)
+        if self._details_built:
+            self._tag_view.get_buffer().set_text(label)
 
     def _title_focus_out_cb(self, widget, event):
         ''' process title text from textview '''
         bounds = widget.get_buffer().get_bounds()
         text = widget.get_buffer().get_text(bounds[0], bounds[1], True)
         self._reflection.data['title'] = text
+        self._reflection.activity.reindex_text(self._reflection.data)
         if self._reflection.activity.sharing:
             self._reflection.activity.send_event(TITLE_CMD,
                 {"obj_id": self._reflection.data["obj_id"],
@@ -592,18 +769,8 @@ class ReflectionGrid(Gtk.EventBox):
         self._reflection.set_modification_time()
 
         # Update journal entry
-        dsobj = datastore.get(self._reflection.data['obj_id'])
-        dsobj.metadata['title'] = text
-        datastore.write(dsobj,
-                        update_mtime=False,
-                        reply_handler=self.datastore_write_cb,
-                        error_handler=self.datastore_write_error_cb)
-
-    def datastore_write_cb(self):
-        logging.debug('ds write cb')
-
-    def datastore_write_error_cb(self, error):
-        logging.error('datastore_write_error_cb: %r' % error)
+        self._reflection.activity.journal_queue.set_metadata(
+            self._reflection.data['obj_id'], 'title', text)
 
     def update_title(self, text):
         ''' process title text from share '''
@@ -621,6 +788,8 @@ class ReflectionGrid(Gtk.EventBox):
                 'color': self._reflection.activity.fg_color.get_html(),
                 'comment': text}
         self._reflection.data['comments'].append(data)
+        self._reflection.activity.mark_dirty(self._reflection.data['obj_id'])
+        self._reflection.activity.reindex_text(self._reflection.data)
         self.add_new_comment(data)
         # Send the comment
         if self._reflection.activity.sharing:
@@ -631,37 +800,19 @@ class ReflectionGrid(Gtk.EventBox):
         entry.set_text('')
 
         # Update journal entry
-        dsobj = datastore.get(self._reflection.data['obj_id'])
-        if 'comments' in dsobj.metadata:
-            data = json.loads(dsobj.metadata['comments'])
-        else:
-            data = []
-        data.append({'from': profile.get_nick_name(),
-                     'message': text,
-                     'icon-color': profile.get_color().to_string()})
-        dsobj.metadata['comments'] = json.dumps(data)
-        datastore.write(dsobj,
-                        update_mtime=False,
-                        reply_handler=self.datastore_write_cb,
-                        error_handler=self.datastore_write_error_cb)
+        self._reflection.activity.journal_queue.add_comment(
+            self._reflection.data['obj_id'],
+            {'from': profile.get_nick_name(),
+             'message': text,
+             'icon-color': profile.get_color().to_string()})
 
     def add_new_comment(self, comment):
-        obj = Gtk.TextView()
-        obj.set_size_request(ENTRY_WIDTH, -1)
-        obj.set_wrap_mode(Gtk.WrapMode.WORD)
-
-        nick_tag = obj.get_buffer().create_tag(
-            'nick', foreground=comment['color'],
-            weight=Pango.Weight.BOLD)
-        iter_text = obj.get_buffer().get_iter_at_offset(0)
-        obj.get_buffer().insert_with_tags(
-            iter_text, comment['nick'] + ': ', nick_tag)
-        iter_text = obj.get_buffer().get_end_iter()
-        obj.get_buffer().insert(iter_text, comment['comment'])
-
-        align = Gtk.Alignment.new(xalign=0, yalign=0.5, xscale=0, yscale=0)
-        align.add(obj)
-        obj.show()
+        # The comment is already in the data; an unbuilt card will pick
+        # it up when it is first expanded.
+        if not self._details_built:
+            return
+        align = self._make_comment_align(comment)
+        self._comment_aligns.append(align)
         self._grid.insert_row(self._comment_row)
         self._grid.attach(align, 1, self._comment_row, 5, 1)
         self._comment_row += 1
@@ -673,6 +824,7 @@ class ReflectionGrid(Gtk.EventBox):
             self._reflection.data['content'] = []
         self._reflection.data['content'].append({'text': text})
         self._reflection.set_modification_time()
+        self._reflection.activity.reindex_text(self._reflection.data)
         self.add_new_reflection(text)
         # Send the reflection
         if self._reflection.activity.sharing:
@@ -695,6 +847,8 @@ class ReflectionGrid(Gtk.EventBox):
         self._grid.insert_row(self._row)
         self._grid.attach(align, 1, self._row, 5, 1)
         self._row += 1
+        if self._details_built:
+            self._comment_row += 1
         align.show()
 
     def _activity_button_cb(self, button, event):
@@ -714,7 +868,7 @@ class ReflectionGrid(Gtk.EventBox):
                 icon_path = bundle_icons[bundle_id]
                 if icon_path is None:
                     continue
-                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
+                pixbuf = utils.get_pixbuf_from_file(
                     icon_path, style.GRID_CELL_SIZE, style.GRID_CELL_SIZE)
                 image = Gtk.Image.new_from_pixbuf(pixbuf)
                 button = Gtk.ToolButton()
@@ -758,7 +912,7 @@ class ReflectionGrid(Gtk.EventBox):
                 if icon_path is None:
                     continue
                 try:
-                    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
+                    pixbuf = utils.get_pixbuf_from_file(
                         icon_path, BUTTON_SIZE, BUTTON_SIZE)
                 except Exception as e:
                     logging.error('Could not find icon %s: %s' %
@@ -829,25 +983,33 @@ class ReflectionGrid(Gtk.EventBox):
                 del chooser
 
             if name is not None:
-                pixbuf = self.add_new_picture(jobject.file_path)
+                try:
+                    digest, path = utils.store_image(jobject.file_path)
+                except (IOError, OSError) as e:
+                    logging.error('Could not store %s: %s' %
+                                  (jobject.file_path, e))
+                    digest, path = None, jobject.file_path
+                pixbuf = self.add_new_picture(path, digest)
                 self._reflection.set_modification_time()
                 if self._reflection.activity.sharing and pixbuf is not None:
                     self._reflection.activity.send_event(PICTURE_CMD,
-                        {"basename": os.path.basename(jobject.file_path),
+                        {"basename": os.path.basename(path),
+                         "digest": digest,
                          "data": utils.pixbuf_to_base64(pixbuf)})
                     self._reflection.activity.send_event(IMAGE_REFLECTION_CMD,
                         {"obj_id": self._reflection.data["obj_id"],
-                         "basename": os.path.basename(jobject.file_path)})
+                         "basename": os.path.basename(path),
+                         "digest": digest})
 
         self._reflection.activity.reset_cursor()
 
-    def add_new_picture(self, path):
+    def add_new_picture(self, path, digest=None):
         try:
-            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                path, PICTURE_WIDTH, PICTURE_HEIGHT)
+            pixbuf = utils.get_pixbuf_from_file(
+                path, PICTURE_WIDTH, PICTURE_HEIGHT, thumbnail=True)
             obj = Gtk.Image.new_from_pixbuf(pixbuf)
         except:
-            logging.error('could not open %s' % jobject.file_path)
+            logging.error('could not open %s' % path)
             return None
 
         align = Gtk.Alignment.new(
@@ -857,16 +1019,26 @@ class ReflectionGrid(Gtk.EventBox):
         self._grid.insert_row(self._row)
         self._grid.attach(align, 1, self._row, 5, 1)
         self._row += 1
+        if self._details_built:
+            self._comment_row += 1
         align.show()
         if not 'content' in self._reflection.data:
             self._reflection.data['content'] = []
-        self._reflection.data['content'].append({'image': path})
+        self._reflection.add_image(path, digest)
 
         if self._reflection.activity.sharing:
             return pixbuf
 
 
+    def can_release(self):
+        ''' Collapsed cards without the focus can be rebuilt from data '''
+        if self._expanded:
+            return False
+        focus = self._reflection.activity.get_focus()
+        return focus is None or not focus.is_ancestor(self)
+
     def _expand_cb(self, button, event):
+        self._expanded = True
         self._grid.set_row_spacing(style.DEFAULT_SPACING)
         if self._collapse_id is not None:
             button.disconnect(self._collapse_id)
@@ -874,6 +1046,8 @@ class ReflectionGrid(Gtk.EventBox):
         button.set_tooltip(_('Collapse'))
         self._collapse_id = button.connect('button-press-event',
                                            self._collapse_cb)
+        if not self._details_built:
+            self._build_details()
         self._tag_align.show()
         if hasattr(self, '_new_tag'):
             self._new_tag.show()
@@ -885,6 +1059,7 @@ class ReflectionGrid(Gtk.EventBox):
         self._new_comment.show()
 
     def _collapse_cb(self, button, event):
+        self._expanded = False
         self._grid.set_row_spacing(0)
         if self._collapse_id is not None:
             button.disconnect(self._collapse_id)
@@ -892,6 +1067,8 @@ class ReflectionGrid(Gtk.EventBox):
         button.set_tooltip(_('Expand'))
         self._collapse_id = button.connect('button-press-event',
                                            self._expand_cb)
+        if not self._details_built:
+            return
         self._tag_align.hide()
         if hasattr(self, '_new_tag'):
             self._new_tag.hide()
@@ -905,7 +1082,7 @@ class ReflectionGrid(Gtk.EventBox):
 
     def __delete_cb(self, button, event):
         self._reflection.activity.delete_item(self._reflection.data['obj_id'])
-        self.hide()
+        self._reflection.slot.hide()
 
 
 class Reflection():
@@ -917,6 +1094,8 @@ class Reflection():
         self.creation_time = None
         self.modification_time = None
         self.obj_id = None
+        self.graphics = None
+        self.slot = None
 
     def set_hidden(self, hidden):
         self.data['hidden'] = hidden
@@ -936,6 +1115,8 @@ class Reflection():
 
     def set_modification_time(self):
         self.data['modification_time'] = int(time.time())
+        if 'obj_id' in self.data:
+            self.activity.mark_dirty(self.data['obj_id'])
 
     def add_tag(self, tag):
         ''' a #tag '''
@@ -949,9 +1130,12 @@ class Reflection():
         ''' simple text '''
         self.data['comments'].append(text)
 
-    def add_image(self, image):
-        ''' an image file pathname '''
-        self.data['content'].append({'image': image})
+    def add_image(self, image, digest=None):
+        ''' an image file pathname and its content digest '''
+        if digest is None:
+            self.data['content'].append({'image': image})
+        else:
+            self.data['content'].append({'image': image, 'digest': digest})
 
     def add_activity(self, activity):
         ''' an activity icon '''
@@ -965,6 +1149,21 @@ class Reflection():
             self.data['activities'] = []
         self.data['activities'].append(activity)
 
+    def update_stars(self, n, count=None):
+        ''' star n was clicked: fill up to it, or clear from it; count,
+        when the sender gives it, is the resulting number of stars '''
+        if 'stars' in self.data:
+            oldn = self.data['stars']
+        else:
+            oldn = 0
+        if count is not None:
+            self.set_stars(int(count))
+        elif n < oldn:  # Erase stars, including one that was clicked
+            self.data['stars'] = n
+        else:  # Add stars, including one that was clicked
+            self.data['stars'] = n + 1
+        self.set_modification_time()
+
     def set_stars(self, n):
         ''' # of stars to highlight '''
         if n < 0:
@@ -980,9 +1179,26 @@ class Reflection():
 
     def refresh(self):
         ''' redraw graphics with updated content '''
-        self.graphics.set_size_request(REFLECTION_WIDTH, -1)
-        if 'hidden' in self.data and self.data['hidden']:
-            self.graphics.hide()
-        else:
+        if self.graphics is not None:
+            self.graphics.set_size_request(REFLECTION_WIDTH, -1)
             self.graphics.show()
-
+        if self.slot is not None:
+            if 'hidden' in self.data and self.data['hidden']:
+                self.slot.hide()
+            else:
+                self.slot.show()
+
+    def estimate_height(self):
+        ''' height of the collapsed card, before it is built '''
+        height = 3 * (BUTTON_SIZE + style.DEFAULT_PADDING)
+        if self.activity.initiating:
+            height += BUTTON_SIZE + style.DEFAULT_PADDING
+        for item in self.data.get('content', []):
+            if 'image' in item:
+                height += PICTURE_HEIGHT + style.DEFAULT_PADDING
+                break
+        for item in self.data.get('content', []):
+            if 'text' in item:
+                height += style.GRID_CELL_SIZE
+                break
+        return height
@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import re
+import math
+import time
+import bisect
+import datetime
+
+import logging
+_logger = logging.getLogger('reflect-search-index')
+
+TITLE_WEIGHT = 3  # a word in the title counts as this many in the text
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    ''' The case-folded words of text '''
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return _WORD.findall(text.lower())
+
+
+def prefix_terms(text):
+    ''' The terms of a search-as-you-type query: '#' words are kept as
+    tag prefixes, the others are split into word prefixes '''
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    terms = []
+    for word in text.split():
+        if word[0] == '#':
+            terms.append(word.lower())
+        else:
+            terms.extend(tokenize(word))
+    return terms
+
+
+def tokenize_tag(tag):
+    ''' The case-folded form of a tag '''
+    if isinstance(tag, str):
+        tag = tag.decode('utf-8', 'replace')
+    return tag.lower()
+
+
+def match_any_prefix(terms, words, tags):
+    ''' True if any term starts one of tags or, if it is not a tag term,
+    one of words; the per-reflection form of a search through the
+    indexes, for reflections that are not indexed or only a few '''
+    tags = [tokenize_tag(tag) for tag in tags]
+    for term in terms:
+        if term[0] == '#':
+            tag_term = term
+        else:
+            tag_term = '#' + term
+            if any(word.startswith(term) for word in words):
+                return True
+        if any(tag.startswith(tag_term) for tag in tags):
+            return True
+    return False
+
+
+class TagIndex(object):
+    ''' Inverted index from each tag to the obj_ids of the reflections
+    that carry it. Tags are case-folded, when indexed and when looked
+    up. '''
+
+    def __init__(self):
+        self._tagged = {}  # tag -> set(obj_id)
+        self._item_tags = {}  # obj_id -> set(tag), to undo a retag
+
+    def rebuild(self, reflection_data):
+        self._tagged = {}
+        self._item_tags = {}
+        for item in reflection_data:
+            if 'obj_id' in item:
+                self.set_tags(item['obj_id'], item.get('tags', []))
+
+    def set_tags(self, obj_id, tags):
+        ''' Replace the tags indexed for obj_id '''
+        old_tags = self._item_tags.get(obj_id, set())
+        new_tags = set([tokenize_tag(tag) for tag in tags])
+        for tag in old_tags - new_tags:
+            obj_ids = self._tagged[tag]
+            obj_ids.discard(obj_id)
+            if len(obj_ids) == 0:
+                del self._tagged[tag]
+        for tag in new_tags - old_tags:
+            self._tagged.setdefault(tag, set()).add(obj_id)
+        if len(new_tags) > 0:
+            self._item_tags[obj_id] = new_tags
+        else:
+            self._item_tags.pop(obj_id, None)
+
+    def remove(self, obj_id):
+        self.set_tags(obj_id, [])
+
+    def any_of(self, tags):
+        ''' obj_ids tagged with at least one of tags '''
+        obj_ids = set()
+        for tag in tags:
+            obj_ids |= self._tagged.get(tokenize_tag(tag), set())
+        return obj_ids
+
+    def tags(self):
+        ''' Every indexed tag '''
+        return self._tagged.keys()
+
+
+class TextIndex(object):
+    ''' Inverted index from each word of the title, text content and
+    comments of a reflection to the number of times it occurs there '''
+
+    def __init__(self):
+        self._postings = {}  # word -> {obj_id: weighted count}
+        self._item_words = {}  # obj_id -> {word: weighted count}
+
+    def rebuild(self, reflection_data):
+        self._postings = {}
+        self._item_words = {}
+        for item in reflection_data:
+            self.index_item(item)
+
+    def index_item(self, item):
+        ''' Replace the words indexed for item '''
+        if 'obj_id' not in item:
+            return
+        obj_id = item['obj_id']
+        counts = {}
+        for word in tokenize(item.get('title', '')):
+            counts[word] = counts.get(word, 0) + TITLE_WEIGHT
+        for content in item.get('content', []):
+            for word in tokenize(content.get('text', '')):
+                counts[word] = counts.get(word, 0) + 1
+        for comment in item.get('comments', []):
+            if isinstance(comment, dict):
+                comment = comment.get('comment', '')
+            for word in tokenize(comment):
+                counts[word] = counts.get(word, 0) + 1
+
+        old_counts = self._item_words.get(obj_id, {})
+        for word in old_counts:
+            if word not in counts:
+                postings = self._postings[word]
+                del postings[obj_id]
+                if len(postings) == 0:
+                    del self._postings[word]
+        for word, count in counts.items():
+            self._postings.setdefault(word, {})[obj_id] = count
+        if len(counts) > 0:
+            self._item_words[obj_id] = counts
+        else:
+            self._item_words.pop(obj_id, None)
+
+    def remove(self, obj_id):
+        self.index_item({'obj_id': obj_id})
+
+    def words(self, obj_id):
+        ''' The words indexed for obj_id '''
+        return self._item_words.get(obj_id, {}).keys()
+
+    def vocabulary(self):
+        ''' Every indexed word '''
+        return self._postings.keys()
+
+    def any_of(self, words):
+        ''' obj_ids containing at least one of words '''
+        obj_ids = set()
+        for word in words:
+            obj_ids.update(self._postings.get(word, {}))
+        return obj_ids
+
+    def search(self, text):
+        ''' obj_ids containing any word of text, best match first. Each
+        word scores (1 + log count) * idf, so rare words and reflections
+        with more of the words rank higher. '''
+        scores = {}
+        total = len(self._item_words)
+        for word in set(tokenize(text)):
+            postings = self._postings.get(word)
+            if postings is None:
+                continue
+            idf = math.log(1. + float(total) / len(postings))
+            for obj_id, count in postings.items():
+                scores[obj_id] = scores.get(obj_id, 0) + \
+                    (1 + math.log(count)) * idf
+        return sorted(scores, key=lambda obj_id: (-scores[obj_id], obj_id))
+
+    def lookup(self, word):
+        ''' obj_ids containing word, or every part of it if it
+        tokenizes to several words '''
+        result = None
+        for token in tokenize(word):
+            obj_ids = set(self._postings.get(token, {}))
+            if result is None:
+                result = obj_ids
+            else:
+                result &= obj_ids
+        if result is None:
+            return set()
+        return result
+
+
+class RangeIndex(object):
+    ''' Sorted (value, obj_id) pairs, for lookups of a range of values '''
+
+    def __init__(self):
+        self._entries = []
+        self._values = {}  # obj_id -> value
+
+    def rebuild(self, pairs):
+        self._values = dict(pairs)
+        self._entries = sorted([(value, obj_id) for obj_id, value
+                                in self._values.items()])
+
+    def set_value(self, obj_id, value):
+        if obj_id in self._values:
+            if self._values[obj_id] == value:
+                return
+            self.remove(obj_id)
+        self._values[obj_id] = value
+        bisect.insort(self._entries, (value, obj_id))
+
+    def remove(self, obj_id):
+        if obj_id not in self._values:
+            return
+        entry = (self._values.pop(obj_id), obj_id)
+        i = bisect.bisect_left(self._entries, entry)
+        if i < len(self._entries) and self._entries[i] == entry:
+            del self._entries[i]
+
+    def range(self, low=None, high=None):
+        ''' obj_ids with low <= value < high; either end may be open '''
+        start = 0
+        end = len(self._entries)
+        if low is not None:
+            start = bisect.bisect_left(self._entries, (low,))
+        if high is not None:
+            end = bisect.bisect_left(self._entries, (high,))
+        return set([obj_id for value, obj_id in self._entries[start:end]])
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _icon_names(icon):
+    ''' The names an activity is known by in its icon path: the bundle
+    directory, e.g. Write.activity, and the icon file, e.g.
+    activity-write.svg, without their suffixes '''
+    segments = tokenize_tag(icon).split('/')
+    names = []
+    for segment in segments[:-1]:
+        if segment.endswith('.activity'):
+            names.append(segment[:-len('.activity')])
+    names.append(segments[-1].rsplit('.', 1)[0])
+    if names[-1].startswith('activity-'):
+        names.append(names[-1][len('activity-'):])
+    return names
+
+
+class FieldIndex(object):
+    ''' Indexes of the fields a query can name besides tags and words:
+    stars, modification time, activities and authors '''
+
+    def __init__(self):
+        self._stars = RangeIndex()
+        self._times = RangeIndex()
+        self._activities = TagIndex()  # activity icon -> obj_ids
+        self._authors = TagIndex()  # case-folded nick -> obj_ids
+
+    def rebuild(self, reflection_data):
+        self._stars.rebuild([(item['obj_id'], _int(item.get('stars')))
+                             for item in reflection_data if 'obj_id' in item])
+        self._times.rebuild([(item['obj_id'],
+                              _int(item.get('modification_time')))
+                             for item in reflection_data if 'obj_id' in item])
+        self._activities = TagIndex()
+        self._authors = TagIndex()
+        for item in reflection_data:
+            if 'obj_id' in item:
+                self._index_sets(item)
+
+    def index_item(self, item):
+        if 'obj_id' not in item:
+            return
+        self._stars.set_value(item['obj_id'], _int(item.get('stars')))
+        self._times.set_value(item['obj_id'],
+                              _int(item.get('modification_time')))
+        self._index_sets(item)
+
+    def _index_sets(self, item):
+        activities = [activity for activity in item.get('activities', [])
+                      if activity is not None]
+        self._activities.set_tags(item['obj_id'], activities)
+        nicks = []
+        if item.get('nick'):
+            nicks.append(tokenize_tag(item['nick']))
+        for comment in item.get('comments', []):
+            if isinstance(comment, dict) and comment.get('nick'):
+                nicks.append(tokenize_tag(comment['nick']))
+        self._authors.set_tags(item['obj_id'], nicks)
+
+    def remove(self, obj_id):
+        self._stars.remove(obj_id)
+        self._times.remove(obj_id)
+        self._activities.remove(obj_id)
+        self._authors.remove(obj_id)
+
+    def stars(self, op, n):
+        if op == '>=':
+            return self._stars.range(low=n)
+        elif op == '>':
+            return self._stars.range(low=n + 1)
+        elif op == '<=':
+            return self._stars.range(high=n + 1)
+        elif op == '<':
+            return self._stars.range(high=n)
+        return self._stars.range(low=n, high=n + 1)
+
+    def modified(self, after=None, before=None):
+        ''' obj_ids modified at or after after and before before '''
+        return self._times.range(low=after, high=before)
+
+    def activities(self, icons, name):
+        ''' obj_ids with one of the activity icons, or an icon whose
+        bundle directory or file name starts with name '''
+        name = tokenize_tag(name)
+        icons = [tokenize_tag(icon) for icon in icons if icon is not None]
+        matching = [icon for icon in self._activities.tags()
+                    if icon in icons or
+                    any(icon_name.startswith(name)
+                        for icon_name in _icon_names(icon))]
+        return self._activities.any_of(matching)
+
+    def authors(self, nick):
+        ''' obj_ids written or commented on by nick '''
+        return self._authors.any_of([tokenize_tag(nick)])
+
+
+class QueryError(ValueError):
+    pass
+
+
+_QUERY_TOKEN = re.compile(r'[()]|[^\s()]+', re.UNICODE)
+_STARS = re.compile(r'^stars(>=|<=|>|<|=)(\d+)$')
+_FIELDS = ['before:', 'after:', 'activity:', 'by:']
+_OPERATORS = ['AND', 'OR', 'NOT']
+
+
+def is_query(text):
+    ''' True if text uses the query language rather than being a plain
+    list of tags and words '''
+    for token in _QUERY_TOKEN.findall(text):
+        if token in _OPERATORS or token in ['(', ')'] or \
+           _STARS.match(token.lower()):
+            return True
+        for field in _FIELDS:
+            if token.lower().startswith(field):
+                return True
+    return False
+
+
+def parse_query(text):
+    ''' Parse a query into a tree of ('or', [nodes]), ('and', [nodes]),
+    ('not', node) and the terms
+        ('tag', '#tag'), ('word', word), ('stars', op, n),
+        ('after', time), ('before', time), ('activity', name),
+        ('by', nick).
+    Terms side by side are ANDed; AND binds more tightly than OR. '''
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    tokens = _QUERY_TOKEN.findall(text)
+    node, i = _parse_or(tokens, 0)
+    if i < len(tokens):
+        raise QueryError('Unexpected %s' % tokens[i])
+    return node
+
+
+def _parse_or(tokens, i):
+    nodes = []
+    node, i = _parse_and(tokens, i)
+    nodes.append(node)
+    while i < len(tokens) and tokens[i] == 'OR':
+        node, i = _parse_and(tokens, i + 1)
+        nodes.append(node)
+    if len(nodes) == 1:
+        return nodes[0], i
+    return ('or', nodes), i
+
+
+def _parse_and(tokens, i):
+    nodes = []
+    while i < len(tokens) and tokens[i] not in ['OR', ')']:
+        if tokens[i] == 'AND':
+            i += 1
+        node, i = _parse_not(tokens, i)
+        nodes.append(node)
+    if len(nodes) == 0:
+        raise QueryError('Missing term')
+    if len(nodes) == 1:
+        return nodes[0], i
+    return ('and', nodes), i
+
+
+def _parse_not(tokens, i):
+    if i >= len(tokens):
+        raise QueryError('Missing term')
+    if tokens[i] == 'NOT':
+        node, i = _parse_not(tokens, i + 1)
+        return ('not', node), i
+    if tokens[i] == '(':
+        node, i = _parse_or(tokens, i + 1)
+        if i >= len(tokens) or tokens[i] != ')':
+            raise QueryError('Missing )')
+        return node, i + 1
+    if tokens[i] in _OPERATORS or tokens[i] == ')':
+        raise QueryError('Unexpected %s' % tokens[i])
+    return _parse_term(tokens[i]), i + 1
+
+
+def _parse_date(text):
+    try:
+        return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+    except ValueError:
+        raise QueryError('Bad date %s; use YYYY-MM-DD' % text)
+
+
+def _timestamp(date):
+    return int(time.mktime(date.timetuple()))
+
+
+def _parse_term(token):
+    match = _STARS.match(token.lower())
+    if match is not None:
+        return ('stars', match.group(1), int(match.group(2)))
+    field, sep, value = token.partition(':')
+    field = field.lower()
+    if sep and field in ['before', 'after', 'activity', 'by']:
+        if value == '':
+            raise QueryError('Missing value for %s:' % field)
+        if field == 'before':
+            # Modified before the start of the day
+            return ('before', _timestamp(_parse_date(value)))
+        elif field == 'after':
+            # Modified after the end of the day
+            return ('after', _timestamp(_parse_date(value) +
+                                        datetime.timedelta(days=1)))
+        return (field, value)
+    if token[0] == '#':
+        return ('tag', token)
+    return ('word', token)
+
+
+def evaluate(node, lookup, universe):
+    ''' The set of obj_ids matching a parsed query. lookup maps a term
+    to its obj_ids; universe holds every obj_id, for NOT. '''
+    kind = node[0]
+    if kind == 'or':
+        result = set()
+        for child in node[1]:
+            result |= evaluate(child, lookup, universe)
+        return result
+    elif kind == 'and':
+        # Intersect the positive terms, then take out the negated ones
+        result = None
+        for child in node[1]:
+            if child[0] != 'not':
+                obj_ids = evaluate(child, lookup, universe)
+                if result is None:
+                    result = set(obj_ids)
+                else:
+                    result &= obj_ids
+                if len(result) == 0:
+                    return result
+        if result is None:
+            result = set(universe)
+        for child in node[1]:
+            if child[0] == 'not':
+                result -= evaluate(child[1], lookup, universe)
+        return result
+    elif kind == 'not':
+        return set(universe) - evaluate(node[1], lookup, universe)
+    return lookup(node)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import searchindex
+
+WRITE_ICON = '/usr/share/sugar/activities/Write.activity/activity/' \
+    'activity-write.svg'
+
+
+class FieldIndexActivitiesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = searchindex.FieldIndex()
+        self.index.rebuild([{'obj_id': 'a', 'activities': [WRITE_ICON]}])
+
+    def test_bundle_name_matches(self):
+        self.assertEqual(self.index.activities([None], 'write'), set(['a']))
+        self.assertEqual(self.index.activities([None], 'Wri'), set(['a']))
+
+    def test_icon_matches(self):
+        self.assertEqual(self.index.activities([WRITE_ICON], 'org.laptop'),
+                         set(['a']))
+
+    def test_path_segment_does_not_match(self):
+        self.assertEqual(self.index.activities([None], 'share'), set())
+        self.assertEqual(self.index.activities([None], 'sugar'), set())
+        self.assertEqual(self.index.activities([None], 'usr'), set())
+
+
+class TagIndexTest(unittest.TestCase):
+
+    def test_tags_are_case_folded(self):
+        index = searchindex.TagIndex()
+        index.set_tags('a', ['#math'])
+        index.set_tags('b', ['#Art'])
+        self.assertEqual(index.any_of(['#Math']), set(['a']))
+        self.assertEqual(index.any_of(['#art']), set(['b']))
+
+
+class MatchAnyPrefixTest(unittest.TestCase):
+
+    def test_any_tag_matches(self):
+        terms = searchindex.prefix_terms('#math #art')
+        self.assertTrue(searchindex.match_any_prefix(terms, [], ['#Math']))
+        self.assertFalse(searchindex.match_any_prefix(terms, [], ['#music']))
+
+    def test_word_prefix_matches_words_and_tags(self):
+        terms = searchindex.prefix_terms('pai')
+        self.assertTrue(searchindex.match_any_prefix(terms, ['painting'], []))
+        self.assertTrue(searchindex.match_any_prefix(terms, [], ['#paint']))
+        self.assertFalse(searchindex.match_any_prefix(terms, ['art'], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
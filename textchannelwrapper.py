@@ -333,6 +333,8 @@ class CollabWrapper(GObject.GObject):
 
     def __buddy_left_cb(self, sender, buddy):
         '''A buddy left.'''
+        if self._text_channel is not None:
+            self._text_channel.forget_buddy(buddy)
         self.buddy_left.emit(buddy)
 
     def get_client_name(self):
@@ -658,6 +660,10 @@ class _TextChannelWrapper(object):
         self._text_chan = text_chan
         self._conn = conn
         self._signal_matches = []
+        # Buddy resolution is cached per channel-specific handle; the
+        # handles of a buddy who left may be reused, see forget_buddy.
+        self._buddies = {}
+        self._handle_context = None
         m = self._text_chan[CHANNEL_INTERFACE].connect_to_signal(
             'Closed', self._closed_cb)
         self._signal_matches.append(m)
@@ -690,6 +696,8 @@ class _TextChannelWrapper(object):
             match.remove()
         self._signal_matches = []
         self._text_chan = None
+        self._buddies = {}
+        self._handle_context = None
         if self._activity_close_cb is not None:
             self._activity_close_cb()
 
@@ -734,8 +742,11 @@ class _TextChannelWrapper(object):
                 _logger.debug('exception: recieved from sender %r buddy %r' %
                               (sender, buddy))
             else:
-                # XXX: cache these
-                buddy = self._get_buddy(sender)
+                buddy = self._buddies.get(sender)
+                if buddy is None:
+                    buddy = self._get_buddy(sender)
+                    if buddy is not None:
+                        self._buddies[sender] = buddy
                 _logger.debug('Else: recieved from sender %r buddy %r' %
                               (sender, buddy))
 
@@ -754,23 +765,46 @@ class _TextChannelWrapper(object):
         _logger.debug('set closed callback')
         self._activity_close_cb = callback
 
+    def forget_buddy(self, buddy):
+        '''Drop the cached handles of a buddy who left.'''
+        for cs_handle, cached in self._buddies.items():
+            if cached is buddy:
+                del self._buddies[cs_handle]
+
+    def _get_handle_context(self):
+        '''The connection and group details that do not change for the
+        life of the channel, fetched once.'''
+        if self._handle_context is None:
+            # Get the Presence Service
+            pservice = presenceservice.get_instance()
+
+            # Get the Telepathy Connection
+            tp_name, tp_path = pservice.get_preferred_connection()
+            conn = Connection(tp_name, tp_path)
+            group = self._text_chan[CHANNEL_INTERFACE_GROUP]
+            self._handle_context = {
+                'pservice': pservice,
+                'tp_name': tp_name,
+                'tp_path': tp_path,
+                'self_handle': conn.GetSelfHandle(),
+                'my_csh': group.GetSelfHandle(),
+                'channel_specific': bool(
+                    group.GetGroupFlags() &
+                    CHANNEL_GROUP_FLAG_CHANNEL_SPECIFIC_HANDLES)}
+        return self._handle_context
+
     def _get_buddy(self, cs_handle):
         '''Get a Buddy from a (possibly channel-specific) handle.'''
         # XXX This will be made redundant once Presence Service
         # provides buddy resolution
-
-        # Get the Presence Service
-        pservice = presenceservice.get_instance()
-
-        # Get the Telepathy Connection
-        tp_name, tp_path = pservice.get_preferred_connection()
-        conn = Connection(tp_name, tp_path)
+        context = self._get_handle_context()
+        pservice = context['pservice']
+        tp_name = context['tp_name']
+        tp_path = context['tp_path']
         group = self._text_chan[CHANNEL_INTERFACE_GROUP]
-        my_csh = group.GetSelfHandle()
-        if my_csh == cs_handle:
-            handle = conn.GetSelfHandle()
-        elif (group.GetGroupFlags() &
-              CHANNEL_GROUP_FLAG_CHANNEL_SPECIFIC_HANDLES):
+        if context['my_csh'] == cs_handle:
+            handle = context['self_handle']
+        elif context['channel_specific']:
             handle = group.GetHandleOwners([cs_handle])[0]
         else:
             handle = cs_handle
@@ -12,11 +12,15 @@
 
 import os
 import json
+import struct
+import base64
+import hashlib
 import subprocess
 import dbus
 import stat
 import statvfs
 import glob
+import shutil
 import urllib
 from random import uniform
 import tempfile
@@ -24,6 +28,7 @@ import cairo
 import email.utils
 import re
 import time
+from collections import OrderedDict
 from ConfigParser import ConfigParser
 
 from gi.repository import Vte
@@ -82,47 +87,283 @@ bundle_icons = {}
 TRAINING_DATA = 'training-data-%s'
 TRAINING_SUFFIX = '.txt'
 
+# Upper bound on the decoded pixel data kept by get_pixbuf_from_file
+PIXBUF_CACHE_BUDGET = 16 * 1024 * 1024
+
+_pixbuf_cache = OrderedDict()
+_pixbuf_cache_bytes = 0
+
+# Directory of persistent thumbnails; see set_thumbnail_path
+_thumbnail_path = None
+# Directory of content-addressed reflection images; see set_image_path
+_image_path = None
+_content_digests = {}
+_DIGEST = re.compile(r'^[0-9a-f]{40}\Z')
+PREVIEW_SUFFIX = '-preview'  # a received thumbnail of a stored image
+
 
 def file_to_base64(path):
     ''' Given a file, convert its contents to base64 '''
-    base64file = os.path.join('/tmp', 'base64tmp')
-    cmd = 'base64 <' + path + ' >' + base64file
-    subprocess.check_call(cmd, shell=True)
-    fd = open(base64file, 'r')
-    base64data = fd.read()
-    fd.close()
-    os.remove(base64file)
-    return base64data
+    fd = open(path, 'rb')
+    try:
+        return base64.b64encode(fd.read())
+    finally:
+        fd.close()
+
+
+def pixbuf_to_png(pixbuf, width=120, height=90):
+    ''' Convert pixbuf to PNG data '''
+    if pixbuf.get_width() != width or pixbuf.get_height() != height:
+        pixbuf = pixbuf.scale_simple(
+            width, height, GdkPixbuf.InterpType.NEAREST)
+    success, data = pixbuf.save_to_bufferv('png', [], [])
+    return data
 
 
 def pixbuf_to_base64(pixbuf, width=120, height=90):
-    ''' Convert pixbuf to base64-encoded data '''
-    pixbuf = pixbuf.scale_simple(
-        width, height, GdkPixbuf.InterpType.NEAREST)
-    path = os.path.join('/tmp', 'imagetmp.png')
-    pixbuf.savev(path, "png", [], [])
-    base64data = file_to_base64(path)
-    os.remove(path)
-    return base64data
+    ''' Convert pixbuf to base64-encoded PNG data '''
+    return base64.b64encode(pixbuf_to_png(pixbuf, width, height))
+
+
+def pack_records(records):
+    ''' Pack (name, data) pairs as length-prefixed records '''
+    chunks = []
+    for name, data in records:
+        name = name.encode('utf-8')
+        chunks.append(struct.pack('>I', len(name)))
+        chunks.append(name)
+        chunks.append(struct.pack('>I', len(data)))
+        chunks.append(data)
+    return ''.join(chunks)
+
+
+def unpack_records(data):
+    ''' Unpack the complete records at the start of data. Returns the
+    (name, data) pairs and the number of bytes they used, so a partly
+    received archive can be read as it grows. '''
+    records = []
+    offset = 0
+    while offset + 4 <= len(data):
+        name_size = struct.unpack('>I', data[offset:offset + 4])[0]
+        start = offset + 4 + name_size
+        if start + 4 > len(data):
+            break
+        data_size = struct.unpack('>I', data[start:start + 4])[0]
+        end = start + 4 + data_size
+        if end > len(data):
+            break
+        records.append((data[offset + 4:start].decode('utf-8'),
+                        data[start + 4:end]))
+        offset = end
+    return records, offset
 
 
 def base64_to_file(base64data, path):
     ''' Given a file, convert its contents from base64 '''
-    base64file = os.path.join('/tmp', 'base64tmp')
-    fd = open(base64file, 'w')
-    fd.write(base64data)
-    fd.close()
-    cmd = 'base64 -d <' + base64file + '>' + path
-    subprocess.check_call(cmd, shell=True)
-    os.remove(base64file)
+    fd = open(path, 'wb')
+    try:
+        fd.write(base64.b64decode(base64data))
+    finally:
+        fd.close()
 
 
 def base64_to_pixbuf(base64data, width=120, height=90):
     ''' Convert base64-encoded data to a pixbuf '''
-    path = os.path.join('/tmp', 'imagetmp.png')
-    base64_to_file(base64data, path)
+    def _size_prepared_cb(loader, w, h):
+        # Scale to fit, preserving the aspect ratio
+        scale = min(float(width) / w, float(height) / h)
+        loader.set_size(max(1, int(w * scale)), max(1, int(h * scale)))
+
+    loader = GdkPixbuf.PixbufLoader()
+    loader.connect('size-prepared', _size_prepared_cb)
+    try:
+        loader.write(base64.b64decode(base64data))
+    finally:
+        loader.close()
+    return loader.get_pixbuf()
+
+
+def get_pixbuf_from_file(path, width, height, thumbnail=False):
+    ''' Load a pixbuf scaled to width x height, sharing the result with
+    every other caller asking for the same file at the same size. Entries
+    are keyed by (path, mtime, width, height) and evicted least recently
+    used first once PIXBUF_CACHE_BUDGET bytes are held. With thumbnail,
+    misses go through the persistent thumbnail store. '''
+    global _pixbuf_cache_bytes
+    key = (path, os.path.getmtime(path), width, height)
+    if key in _pixbuf_cache:
+        pixbuf = _pixbuf_cache.pop(key)
+        _pixbuf_cache[key] = pixbuf
+        return pixbuf
+
+    if thumbnail:
+        pixbuf = get_thumbnail(path, width, height)
+    else:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(path, width, height)
+    size = pixbuf.get_rowstride() * pixbuf.get_height()
+    if size > PIXBUF_CACHE_BUDGET:
+        return pixbuf
+    _pixbuf_cache[key] = pixbuf
+    _pixbuf_cache_bytes += size
+    while _pixbuf_cache_bytes > PIXBUF_CACHE_BUDGET:
+        old_key, old_pixbuf = _pixbuf_cache.popitem(last=False)
+        _pixbuf_cache_bytes -= \
+            old_pixbuf.get_rowstride() * old_pixbuf.get_height()
+    return pixbuf
+
+
+def _make_directory(path):
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            _logger.error('Could not create directory %s: %s' % (path, e))
+            return False
+    return True
+
+
+def set_thumbnail_path(path):
+    ''' Keep thumbnails under path (created if need be) '''
+    global _thumbnail_path
+    if _make_directory(path):
+        _thumbnail_path = path
+
+
+def set_image_path(path):
+    ''' Keep reflection images under path (created if need be) '''
+    global _image_path
+    if _make_directory(path):
+        _image_path = path
+
+
+def is_digest(digest):
+    ''' True for a sha1 hex digest, the only names used in the store '''
+    return isinstance(digest, basestring) and \
+        _DIGEST.match(digest) is not None
+
+
+def get_image_path(digest):
+    ''' Where the image with this content digest is stored '''
+    if not is_digest(digest):
+        raise ValueError('Bad image digest %r' % digest)
+    return os.path.join(_image_path, digest)
+
+
+def get_preview_path(digest):
+    ''' Where a thumbnail received for the image with this content digest
+    is stored; it is not named by its own digest, since the image it
+    stands in for may be stored later '''
+    return get_image_path(digest) + PREVIEW_SUFFIX
+
+
+def find_image(digest):
+    ''' The stored image with this digest, or else its received preview;
+    the image path if neither is there yet '''
+    path = get_image_path(digest)
+    if not os.path.exists(path) and os.path.exists(get_preview_path(digest)):
+        return get_preview_path(digest)
+    return path
+
+
+def has_image(digest):
+    ''' True if the image, or a preview of it, is in the store '''
+    return _image_path is not None and is_digest(digest) and \
+        (os.path.exists(get_image_path(digest)) or
+         os.path.exists(get_preview_path(digest)))
+
+
+def get_image_digests():
+    ''' Digests of every image in the store, or previewed in it '''
+    if _image_path is None:
+        return []
+    digests = set()
+    for name in os.listdir(_image_path):
+        if name.endswith(PREVIEW_SUFFIX):
+            name = name[:-len(PREVIEW_SUFFIX)]
+        if is_digest(name):
+            digests.add(name)
+    return list(digests)
+
+
+def store_image(path):
+    ''' Add an image file to the store, returning its digest and the path
+    of the stored image. The file is hardlinked where possible, and an
+    image that is already in the store is not copied again. '''
+    digest = get_content_digest(path)
+    stored = get_image_path(digest)
+    if not os.path.exists(stored):
+        try:
+            os.link(path, stored)
+        except OSError:
+            if not os.path.exists(stored):
+                fd, tmp_path = tempfile.mkstemp(suffix='.tmp',
+                                                dir=_image_path)
+                os.close(fd)
+                shutil.copy(path, tmp_path)
+                os.rename(tmp_path, stored)
+    return digest, stored
+
+
+def store_image_data(data):
+    ''' Add image data to the store, returning its digest and the path of
+    the stored image '''
+    digest = hashlib.sha1(data).hexdigest()
+    return digest, _store_data(data, get_image_path(digest))
+
+
+def store_preview_data(data, digest):
+    ''' Add a thumbnail of the image with digest (which must be a valid
+    digest) to the store, returning the path of the stored preview '''
+    return _store_data(data, get_preview_path(digest))
+
+
+def _store_data(data, stored):
+    if not os.path.exists(stored):
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=_image_path)
+        os.write(fd, data)
+        os.close(fd)
+        os.rename(tmp_path, stored)
+    return stored
+
+
+def get_content_digest(path):
+    ''' sha1 of the file contents, remembered per (path, mtime, size) '''
+    info = os.stat(path)
+    key = (path, info.st_mtime, info.st_size)
+    if key not in _content_digests:
+        sha1 = hashlib.sha1()
+        fd = open(path, 'rb')
+        try:
+            for chunk in iter(lambda: fd.read(65536), ''):
+                sha1.update(chunk)
+        finally:
+            fd.close()
+        _content_digests[key] = sha1.hexdigest()
+    return _content_digests[key]
+
+
+def get_thumbnail(path, width, height):
+    ''' Load path scaled to width x height. The scaled image is stored
+    by content hash and size in the thumbnail directory, so the same
+    image is only decoded at a given size once across launches. '''
+    if _thumbnail_path is None:
+        return GdkPixbuf.Pixbuf.new_from_file_at_size(path, width, height)
+
+    thumbnail = os.path.join(_thumbnail_path, '%s-%dx%d.png' %
+                             (get_content_digest(path), width, height))
+    if os.path.exists(thumbnail):
+        try:
+            return GdkPixbuf.Pixbuf.new_from_file(thumbnail)
+        except Exception as e:
+            _logger.error('Could not read thumbnail %s: %s' % (thumbnail, e))
+
     pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(path, width, height)
-    os.remove(path)
+    tmp_path = thumbnail + '.tmp'
+    try:
+        pixbuf.savev(tmp_path, 'png', [], [])
+        os.rename(tmp_path, thumbnail)
+    except Exception as e:
+        _logger.error('Could not save thumbnail %s: %s' % (thumbnail, e))
     return pixbuf
 
 
@@ -195,11 +436,16 @@ def save_pixbuf_to_file(pixbuf, path):
 
 def get_pixbuf_from_journal(dsobject, w, h):
     """ Load a pixbuf from a Journal object. """
+    return get_pixbuf_from_preview(dsobject.metadata['preview'], w, h)
+
+
+def get_pixbuf_from_preview(preview, w, h):
+    """ Load a pixbuf from Journal preview data (safe in a worker thread). """
     pixbufloader = \
         GdkPixbuf.PixbufLoader.new_with_mime_type('image/png')
     pixbufloader.set_size(min(300, int(w)), min(225, int(h)))
     try:
-        pixbufloader.write(dsobject.metadata['preview'])
+        pixbufloader.write(preview)
         pixbuf = pixbufloader.get_pixbuf()
     except:
         pixbuf = None
@@ -556,6 +802,15 @@ def get_battery_level():
     return battery_model.props.level
 
 
+def get_fsync_mode(default):
+    ''' How saves are synced to disk: 'always' or 'timer' '''
+    client = GConf.Client.get_default()
+    mode = client.get_string('/desktop/sugar/activities/reflect/fsync_mode')
+    if mode in ['always', 'timer']:
+        return mode
+    return default
+
+
 def get_sound_level():
     client = GConf.Client.get_default()
     return client.get_int('/desktop/sugar/sound/volume')